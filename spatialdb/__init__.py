@@ -1,2 +1,45 @@
-from .core import *
+"""
+Spatial extensions for db2 (SpatiaLite).
+
+``spatialdb.core`` (and with it fiona, geopandas, pandas, sqlalchemy and db2)
+is only imported the first time one of its names is accessed, keeping
+``import spatialdb`` cheap for short-lived processes.
+"""
+from importlib import import_module
+
 from . import utils
+from .utils import get_sr_from_web, SpatiaLiteBlobElement
+
+# Public names of the submodules, loaded lazily by __getattr__
+_LAZY_NAMES = {
+    "GEOM_TYPES": "base",
+    "SpatialDB": "base",
+    "BatchWriter": "core",
+    "LAYER_STATS_TABLE": "core",
+    "LOD_TABLE": "core",
+    "LookupIndex": "core",
+    "MOD_SPATIALITE": "core",
+    "ROW_HASHES_TABLE": "core",
+    "SpatiaLiteDB": "core",
+    "SpatiaLiteError": "core",
+    "DuckDBSpatialDB": "duckdb_spatial",
+    }
+
+# duckdb is optional: DuckDBSpatialDB is only imported when named explicitly
+__all__ = ["get_sr_from_web", "SpatiaLiteBlobElement", "utils"] + sorted(
+    name for name, module in _LAZY_NAMES.items()
+    if module != "duckdb_spatial")
+
+
+def __getattr__(name):
+    if name in ("base", "core", "duckdb_spatial"):
+        return import_module("." + name, __name__)
+    if name in _LAZY_NAMES:
+        return getattr(
+            import_module("." + _LAZY_NAMES[name], __name__), name)
+    raise AttributeError(
+        "module 'spatialdb' has no attribute '{}'".format(name))
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__) | set(_LAZY_NAMES))
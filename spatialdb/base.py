@@ -0,0 +1,47 @@
+"""
+Backend-independent base of the spatial database classes.
+"""
+
+from abc import ABC, abstractmethod
+
+GEOM_TYPES = {
+    1: "POINT",
+    2: "LINESTRING",
+    3: "POLYGON",
+    4: "MULTIPOINT",
+    5: "MULTILINESTRING",
+    6: "MULTIPOLYGON",
+    7: "GEOMETRYCOLLECTION"
+    }
+
+
+class SpatialDB(ABC):
+    """
+    Abstract base class of spatial databases (e.g. ``SpatiaLiteDB``).
+
+    Subclasses return query results as GeoDataFrames when a 'geometry' column
+    is selected, and describe their spatial tables in ``geometries``.
+    """
+    @abstractmethod
+    def sql(self, q, data=None):
+        """Executes a query and returns a (Geo)DataFrame."""
+
+    @abstractmethod
+    def load_geodataframe(self, gdf, table_name, srid, **kwargs):
+        """Creates a database table from a geopandas.GeoDataFrame."""
+
+    @abstractmethod
+    def get_crs(self, srid):
+        """
+        Get the coordinate reference system (GeoPandas format, i.e. a fiona
+        CRS mapping) of a spatial reference ID.
+        """
+
+    @property
+    @abstractmethod
+    def geometries(self):
+        """DataFrame describing the spatial tables of the database."""
+
+    def get_geometry_data(self, table_name):
+        """Dictionary of geometry column data by f_table_name."""
+        return self.geometries.set_index("f_table_name").loc[table_name]
@@ -16,35 +16,101 @@ pip install GDAL==$(gdal-config --version) --global-option=build_ext --global-op
 
 from __future__ import unicode_literals
 
+import hashlib
+import itertools
+import json
 import os
+import queue
+import re
+import sqlite3
 import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import contextmanager
+from functools import wraps
+from urllib.request import pathname2url
 
 import fiona
 import geopandas as gpd
 import pandas as pd
+import numpy as np
+import shapely
 import shapely.wkt
+from pybars import Compiler
+from pyproj import CRS
+from shapely.geometry import shape
+from shapely.geometry.base import BaseGeometry
 from sqlalchemy import func, select
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy.exc import IntegrityError, OperationalError
 
 from db2 import SQLiteDB
-from .utils import get_sr_from_web, SpatiaLiteBlobElement
-
-# Assume users want access to functions like ImportSHP, ExportSHP, etc.
-os.environ["SPATIALITE_SECURITY"] = "relaxed"
+from .base import GEOM_TYPES, SpatialDB
+from .utils import (get_sr_from_web, hex_bin, hex_polygons, hilbert_keys,
+                    nearest_neighbors, transform_geometries, LRUCache,
+                    SpatiaLiteBlobElement)
 
 if sys.platform.startswith("linux"):
     MOD_SPATIALITE = "/usr/local/lib/mod_spatialite.so"
 else:
     MOD_SPATIALITE = "mod_spatialite"
 
-GEOM_TYPES = {
-    1: "POINT",
-    2: "LINESTRING",
-    3: "POLYGON",
-    4: "MULTIPOINT",
-    # ...
-    6: "MULTIPOLYGON"
-    }
+# Side table holding per-row content hashes for incremental (upsert) loads
+ROW_HASHES_TABLE = "spatialdb_row_hashes"
+
+# Table registering the simplified geometry tables built by build_lod
+LOD_TABLE = "spatialdb_lod"
+
+# Side table holding the statistics of spatial tables (see table_stats)
+LAYER_STATS_TABLE = "spatialdb_layer_stats"
+
+# Script used by SpatiaLiteDB.alter_geometry (handlebars template)
+# TODO: in future version move this to .sql file in new /scripts folder
+ALTER_GEOMETRY_SCRIPT = (
+    # CloneTable (try to drop first)
+    "SELECT DropGeoTable('{{ table_name }}_bk')"
+    ";\n"
+    "SELECT "
+    "  CloneTable('main', '{{ table_name }}', '{{ table_name }}_bk', "
+    "  1, '::ignore::geometry');\n"
+    # AddGeometryColumn
+    "SELECT "
+    "  AddGeometryColumn('{{ table_name }}_bk', 'geometry', "
+    "  {{ srid }}, '{{ geom_type }}', '{{ dims }}', {{ not_null }});\n"
+    # Update altered geometry
+    "UPDATE {{ table_name }}_bk "
+    "  SET geometry = (SELECT {{ funcs }} "
+    "  FROM {{ table_name }} "
+    "  WHERE {{ table_name }}_bk.rowid={{ table_name }}.rowid);\n"
+    # Drop original table
+    "SELECT DropGeoTable('{{ table_name }}');\n"
+    # Clone new table into original name
+    "SELECT "
+    "  CloneTable('main', '{{ table_name }}_bk', '{{ table_name }}', "
+    "  1);\n"
+    # Drop _bk table
+    "SELECT DropGeoTable('{{ table_name }}_bk');"
+    "VACUUM;"
+    )
+
+
+def _defer_writeback(method):
+    """
+    Decorates the multi-step methods of ``SpatiaLiteDB`` so that write-backs
+    of in-memory mirrors (see ``open_in_memory``) never happen halfway
+    through them; one is considered once the outermost call returns.
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self._writeback_depth += 1
+        try:
+            result = method(self, *args, **kwargs)
+        finally:
+            self._writeback_depth -= 1
+        self._maybe_checkpoint()
+        return result
+    return wrapper
+
 
 # TODO: something that allows users the option to raise errors on column names
 # that are greater than 10 chars long
@@ -57,7 +123,7 @@ class SpatiaLiteError(Exception):
     pass
 
 
-class SpatiaLiteDB(SQLiteDB):
+class SpatiaLiteDB(SQLiteDB, SpatialDB):
     """
     Utility for exploring and querying a SpatiaLite database.
 
@@ -69,9 +135,26 @@ class SpatiaLiteDB(SQLiteDB):
         Whether or not to repeat queries and messages back to user
     extensions: list
         List of extensions to load on connection. Default: ['mod_spatialite']
+    template_cache_size: int
+        Number of compiled handlebars templates to keep. Default 128
+    statement_cache_size: int
+        Number of rendered SQL statements to keep. Default 256
     """
     def __init__(self, dbname, echo=False, extensions=[MOD_SPATIALITE],
-                 functions=None, pragmas=None):
+                 functions=None, pragmas=None, template_cache_size=128,
+                 statement_cache_size=256):
+        # Assume users want access to functions like ImportSHP, ExportSHP,
+        # etc. (must be set before mod_spatialite is loaded)
+        os.environ.setdefault("SPATIALITE_SECURITY", "relaxed")
+        # Periodic write-back settings of in-memory mirrors (open_in_memory)
+        self._writeback = None
+        self._writeback_depth = 0
+        # Loaded again by the connections of worker processes and threads
+        self._extensions = list(extensions)
+        # Compiled handlebars templates and rendered statements
+        self._handlebars = Compiler()
+        self._template_cache = LRUCache(template_cache_size)
+        self._statement_cache = LRUCache(statement_cache_size)
         super(SpatiaLiteDB, self).__init__(
             dbname=dbname,
             echo=echo,
@@ -88,6 +171,176 @@ class SpatiaLiteDB(SQLiteDB):
             self.engine.execute(select([func.InitSpatialMetaData(1)]))
             self.schema.refresh()
 
+    @classmethod
+    def open_in_memory(cls, path, pages=1024, writeback=None, progress=None,
+                       **kwargs):
+        """
+        Copies an on-disk database into a new in-memory database using the
+        SQLite backup API (spatial metadata and indexes included).
+
+        Parameters
+        ----------
+        path: str
+            Path to the on-disk SQLite database to mirror
+        pages: int
+            Number of pages copied per backup step. Default 1024
+        writeback: int or float
+            Optional number of seconds between write-backs. When set, changes
+            are copied back to ``path`` by the first query (``sql()``) or
+            method call completed after the interval has passed, or by
+            calling ``checkpoint()``. Write-backs are driven by this activity
+            only: nothing is written while the database is idle.
+        progress: callable
+            Called as ``progress(status, remaining, total)`` after each step.
+        Any other kwargs are passed to the constructor.
+
+        Returns
+        -------
+        SpatiaLiteDB
+        """
+        if not os.path.exists(path):
+            raise AttributeError("cannot find path specified")
+        db = cls(":memory:", **kwargs)
+        src = sqlite3.connect(path)
+        try:
+            with db._raw_connection() as con:
+                src.backup(con, pages=pages, progress=progress)
+        finally:
+            src.close()
+        db.schema.refresh()
+        if writeback is not None:
+            db._writeback = {
+                "path": path,
+                "interval": writeback,
+                "time": time.time(),
+                "changes": db._total_changes(),
+                "schema_version": db._schema_version()}
+        return db
+
+    def snapshot_to(self, path, pages=1024, progress=None):
+        """
+        Copies this database to ``path`` using the SQLite backup API.
+
+        Parameters
+        ----------
+        path: str
+            Path of the SQLite database to write (replaced if it exists)
+        pages: int
+            Number of pages copied per backup step. Default 1024
+        progress: callable
+            Called as ``progress(status, remaining, total)`` after each step.
+        """
+        dst = sqlite3.connect(path)
+        try:
+            with self._raw_connection() as con:
+                con.backup(dst, pages=pages, progress=progress)
+        finally:
+            dst.close()
+
+    def checkpoint(self):
+        """
+        Writes the changes of an in-memory mirror back to disk (see
+        ``open_in_memory``). Returns True if anything was written.
+        """
+        if self._writeback is None:
+            raise SpatiaLiteError("no write-back path set")
+        # total_changes only counts rows; DDL bumps the schema version
+        changes = self._total_changes()
+        schema_version = self._schema_version()
+        self._writeback["time"] = time.time()
+        if (changes == self._writeback["changes"] and
+                schema_version == self._writeback["schema_version"]):
+            return False
+        self.snapshot_to(self._writeback["path"])
+        self._writeback["changes"] = changes
+        self._writeback["schema_version"] = schema_version
+        return True
+
+    def _maybe_checkpoint(self):
+        """
+        Calls ``checkpoint()`` if the write-back interval has passed (and no
+        multi-step method is running).
+        """
+        if self._writeback is None or self._writeback_depth:
+            return
+        elapsed = time.time() - self._writeback["time"]
+        if elapsed >= self._writeback["interval"]:
+            self.checkpoint()
+
+    @contextmanager
+    def _raw_connection(self):
+        """
+        Yields the engine's underlying sqlite3 connection (for in-memory
+        databases, the one holding the data).
+        """
+        fairy = self.engine.raw_connection()
+        try:
+            yield getattr(fairy, "dbapi_connection", None) or fairy.connection
+        finally:
+            fairy.close()
+
+    def _total_changes(self):
+        """Number of rows changed on the engine's connection."""
+        with self._raw_connection() as con:
+            return con.total_changes
+
+    def _schema_version(self):
+        """Schema version (incremented by every schema change)."""
+        with self._raw_connection() as con:
+            return con.execute("PRAGMA schema_version;").fetchone()[0]
+
+    def _apply_handlebars(self, q, data, union=True):
+        """
+        Renders a handlebars query template. Compiled templates and the
+        statements rendered from hashable data are cached, so repeated
+        queries skip rendering and reuse the same SQL text (and with it the
+        prepared statement cached by the sqlite3 connection).
+        """
+        if not isinstance(data, (dict, list)):
+            return q
+        key = None
+        if isinstance(data, dict):
+            try:
+                # Equal values of different types (1, 1.0, True) render
+                # differently
+                key = (q, union, frozenset(
+                    (k, type(v), v) for k, v in data.items()))
+            except TypeError:
+                # Unhashable values
+                key = None
+        if key is not None:
+            statement = self._statement_cache.get(key)
+            if statement is not None:
+                return statement
+
+        template = self._template_cache.get(q)
+        if template is None:
+            template = self._handlebars.compile(q)
+            self._template_cache.put(q, template)
+        if isinstance(data, list):
+            statement = ("\nUNION ALL\n" if union else "\n").join(
+                [str(template(item)) for item in data])
+        else:
+            statement = str(template(data))
+        if key is not None:
+            self._statement_cache.put(key, statement)
+        return statement
+
+    def cache_info(self):
+        """
+        Returns a DataFrame of the hits, misses, hit rate and size of the
+        template and statement caches.
+        """
+        return pd.DataFrame.from_dict(
+            {"templates": self._template_cache.info(),
+             "statements": self._statement_cache.info()},
+            orient="index")
+
+    def clear_cache(self):
+        """Empties the template and statement caches."""
+        self._template_cache.clear()
+        self._statement_cache.clear()
+
     def has_srid(self, srid):
         """
         Check if a spatial reference system is in the database.
@@ -106,8 +359,11 @@ class SpatiaLiteDB(SQLiteDB):
             "SELECT * FROM spatial_ref_sys WHERE srid=?", (srid,)
             ).fetchall()) == 1
 
+    @_defer_writeback
     def load_geodataframe(self, gdf, table_name, srid, validate=True,
-                          if_exists="fail", srid_auth="esri", **kwargs):
+                          if_exists="fail", srid_auth="esri", pk_column=None,
+                          to_srid=None, cluster=False, storage=None,
+                          precision=None, **kwargs):
         """
         Creates a database table from a geopandas.GeoDataFrame
 
@@ -122,21 +378,40 @@ class SpatiaLiteDB(SQLiteDB):
             The name of the table to create from the gdf
         srid: int
             Spatial Reference ID for the geometry
-        if_exists: str ({'fail', 'replace', 'append'}, default 'fail')
+        if_exists: str ({'fail', 'replace', 'append', 'upsert'}, default 'fail')
             How to behave if the table already exists.
 
                 * fail: Raise a ValueError.
                 * replace: Drop the table before inserting new values.
                 * append: Insert new values to the existing table.
+                * upsert: Insert, update and delete only the rows that
+                  changed, matched on ``pk_column``.
 
         srid_auth: str ({'epsg', 'sr-org', 'esri'}, default 'esri')
             If the 'srid' argument value is not in the database, it is
             retrieved from the web. This argument allows users to specify the
             spatial reference authority. Default is 'esri' since most
             'epsg' systems already exist in the spatial_ref_sys table.
+        pk_column: str
+            Name of the column uniquely identifying each feature. Required
+            when ``if_exists`` is 'upsert'.
+        to_srid: int
+            Spatial Reference ID to reproject the geometry to (client-side)
+            before it is loaded. The table is created with this SRID.
+        cluster: bool
+            Rewrite the table in Hilbert curve order after loading (see
+            ``cluster_table``). Default False
+        storage: str ({None, 'compressed'}, default None)
+            Store geometries as SpatiaLite compressed BLOBs (vertices as float
+            deltas), which are smaller but slightly less precise.
+        precision: float
+            Grid size coordinates are snapped to (client-side) before they
+            are loaded, e.g. 0.01 for centimeters in a metric system.
         Any other kwargs are passed to the 'to_sql()' method of the dataframe.
             Note that the 'index' argument is set to False.
         """
+        if storage not in (None, "compressed"):
+            raise AttributeError("Not a valid storage: {}".format(storage))
         # Put the if_exists param in kwargs (passed to df.to_sql())
         kwargs.update({"if_exists": if_exists})
         # TODO: check_security()
@@ -155,6 +430,28 @@ class SpatiaLiteDB(SQLiteDB):
             # Drop wkt series
             gdf = gpd.GeoDataFrame(gdf.drop("wkt", axis=1))
             r = r.append(pd.DataFrame([["wkt.loads", 1]], columns=rcols))
+        # Optionally reproject
+        if to_srid is not None and int(to_srid) != int(srid):
+            if not self.has_srid(to_srid):
+                self.get_spatial_ref_sys(to_srid, srid_auth)
+            gdf["geometry"] = self.transform_geometries(
+                gdf["geometry"], srid, to_srid)
+            srid = to_srid
+            r = r.append(
+                pd.DataFrame([["transform_geometries", len(gdf)]],
+                             columns=rcols))
+        # Optionally reduce precision
+        if precision is not None:
+            gdf["geometry"] = shapely.set_precision(
+                np.asarray(gdf["geometry"]), precision)
+            r = r.append(
+                pd.DataFrame([["set_precision", len(gdf)]], columns=rcols))
+        # Only apply the changed rows
+        if if_exists == "upsert":
+            r = r.append(self._upsert_geodataframe(
+                gdf, table_name, srid, pk_column, validate, storage,
+                **kwargs))
+            return r.reset_index(drop=True)
         # Get geometry type from 'geometry' column
         geom_types = set(gdf["geometry"].geom_type)
         # SpatiaLite can only accept one geometry type
@@ -169,9 +466,14 @@ class SpatiaLiteDB(SQLiteDB):
         # Load the table using pandas
         #gdf.to_sql(table_name, self.dbapi_con, **kwargs)
         gdf.to_sql(table_name, self.con, **kwargs)
+        if if_exists != "append":
+            self._drop_row_hashes(table_name)
         # Convert from WKT to SpatiaLite geometry
+        geom_func = "GeomFromText(geometry, {{srid}})"
+        if storage == "compressed":
+            geom_func = "CompressGeometry({})".format(geom_func)
         r = r.append(self.sql(
-            "UPDATE {{tbl}} SET geometry = GeomFromText(geometry, {{srid}});",
+            "UPDATE {{tbl}} SET geometry = " + geom_func + ";",
             data={"tbl": table_name, "srid": srid})
             )
 
@@ -187,19 +489,182 @@ class SpatiaLiteDB(SQLiteDB):
                 pd.DataFrame([["RecoverGeometryColumn(?, ?, ?, ?)", 1]], columns=rcols))
         # Optionally validate geometries
         if validate:
+            make_valid = "MakeValid(geometry)"
+            if storage == "compressed":
+                make_valid = "CompressGeometry({})".format(make_valid)
             validate_sql = ("UPDATE {{tbl}} "
-                            "SET geometry = MakeValid(geometry) "
+                            "SET geometry = " + make_valid + " "
                             "WHERE NOT IsValid(geometry);")
             r = r.append(self.sql(validate_sql,
                                   data={"tbl": table_name}))
+        if cluster:
+            r = r.append(self.cluster_table(table_name))
+        self._update_layer_stats(
+            table_name, refresh=if_exists != "append" or cluster)
         r = r.append(
             pd.DataFrame([["load_geodataframe()", len(gdf)]], columns=rcols))
         return r.reset_index(drop=True)
 
+    def _upsert_geodataframe(self, gdf, table_name, srid, pk_column,
+                             validate=True, storage=None, **kwargs):
+        """
+        Applies the difference between a GeoDataFrame and an existing table
+        in a single transaction. Rows are matched on ``pk_column`` and
+        compared using the content hashes stored in the ``ROW_HASHES_TABLE``.
+        The spatial index (if any) is kept up to date by SpatiaLite's own
+        triggers.
+        """
+        if pk_column is None:
+            raise AttributeError("'upsert' requires a pk_column")
+        if pk_column not in gdf.columns:
+            raise AttributeError(
+                "pk_column not in GeoDataFrame: {}".format(pk_column))
+        if gdf[pk_column].duplicated().any():
+            raise AttributeError(
+                "pk_column has duplicate values: {}".format(pk_column))
+        rcols = ["SQL", "Result"]
+        self._create_row_hashes_table()
+        hashes = _row_hashes(gdf)
+        pks = gdf[pk_column].astype(object).tolist()
+
+        # New table: load it normally and remember its hashes
+        if table_name not in self.table_names:
+            kwargs.update({"if_exists": "fail", "index": False})
+            r = self.load_geodataframe(gdf.copy(), table_name, srid,
+                                       validate=validate, storage=storage,
+                                       **kwargs)
+            self._store_row_hashes(table_name, zip(pks, hashes))
+            return r
+
+        # Existing rows without a stored hash (e.g. loaded without 'upsert')
+        # are always treated as changed; hashes of rows deleted otherwise
+        # are ignored
+        hashes_stored = dict(self.engine.execute(
+            "SELECT pk, hash FROM {} WHERE table_name = ?".format(
+                ROW_HASHES_TABLE),
+            (table_name,)).fetchall())
+        stored = dict([
+            (i[0], hashes_stored.get(i[0])) for i in self.engine.execute(
+                "SELECT {} FROM {}".format(pk_column, table_name)
+                ).fetchall()])
+        new_hashes = dict(zip(pks, hashes))
+        inserts = [i for i, pk in enumerate(pks) if pk not in stored]
+        updates = [i for i, pk in enumerate(pks)
+                   if pk in stored and stored[pk] != new_hashes[pk]]
+        deletes = [(pk,) for pk in stored if pk not in new_hashes]
+
+        # Build parameterized statements from the GeoDataFrame's columns
+        geom_func = "GeomFromWKB(?, {})".format(int(srid))
+        geom_type = self.get_geometry_data(table_name)["geometry_type"]
+        if int(geom_type) % 1000 in (4, 5, 6):
+            geom_func = "CastToMulti({})".format(geom_func)
+        compress = "CompressGeometry({})" if storage else "{}"
+        geom_func = compress.format(geom_func)
+        cols = [c for c in gdf.columns if c != "geometry"]
+        values = _row_values(gdf, cols)
+        insert_sql = "INSERT INTO {} ({}) VALUES ({});".format(
+            table_name,
+            ", ".join(cols + ["geometry"]),
+            ", ".join(["?"] * len(cols) + [geom_func]))
+        update_sql = "UPDATE {} SET {} WHERE {} = ?;".format(
+            table_name,
+            ", ".join(["{} = ?".format(c) for c in cols] +
+                      ["geometry = {}".format(geom_func)]),
+            pk_column)
+        delete_sql = "DELETE FROM {} WHERE {} = ?;".format(
+            table_name, pk_column)
+        validate_sql = ("UPDATE {0} SET geometry = {2} "
+                        "WHERE {1} = ? AND NOT IsValid(geometry);").format(
+                            table_name, pk_column,
+                            compress.format("MakeValid(geometry)"))
+        hash_sql = ("INSERT OR REPLACE INTO {} (table_name, pk, hash) "
+                    "VALUES (?, ?, ?);").format(ROW_HASHES_TABLE)
+
+        with self.engine.begin() as con:
+            # Statistics are merged if current: the replaced and deleted rows
+            # are removed, then the inserted and updated ones added
+            stats = _current_layer_stats(con, table_name)
+            if stats is not None and (updates or deletes):
+                removed = _pk_layer_stats(
+                    con, table_name, pk_column,
+                    [pks[i] for i in updates] + [pk for pk, in deletes])
+                stats = _merge_layer_stats(stats, removed, -1)
+                # Removed geometries on the border may shrink the extent: the
+                # next table_stats call then scans the table
+                extent, border = stats["extent"], removed["extent"]
+                if extent and border and (
+                        border[0] <= extent[0] or border[1] <= extent[1] or
+                        border[2] >= extent[2] or border[3] >= extent[3]):
+                    stats = None
+            if inserts:
+                con.execute(insert_sql, [values[i] for i in inserts])
+            if updates:
+                con.execute(update_sql,
+                            [values[i] + (pks[i],) for i in updates])
+            if deletes:
+                con.execute(delete_sql, deletes)
+                con.execute(
+                    "DELETE FROM {} WHERE table_name = ? AND pk = ?;".format(
+                        ROW_HASHES_TABLE),
+                    [(table_name, pk) for pk, in deletes])
+            orphans = [(table_name, pk) for pk in hashes_stored
+                       if pk not in stored]
+            if orphans:
+                con.execute(
+                    "DELETE FROM {} WHERE table_name = ? AND pk = ?;".format(
+                        ROW_HASHES_TABLE),
+                    orphans)
+            changed = inserts + updates
+            if changed:
+                if validate:
+                    con.execute(validate_sql, [(pks[i],) for i in changed])
+                con.execute(hash_sql, [(table_name, pks[i], hashes[i])
+                                       for i in changed])
+            if stats is not None:
+                stats = _merge_layer_stats(stats, _pk_layer_stats(
+                    con, table_name, pk_column, [pks[i] for i in changed]))
+                _store_layer_stats(con, table_name, stats,
+                                   _data_version(con, table_name))
+        return pd.DataFrame([["INSERT", len(inserts)],
+                             ["UPDATE", len(updates)],
+                             ["DELETE", len(deletes)]], columns=rcols)
+
+    def _create_row_hashes_table(self):
+        """Creates the ``ROW_HASHES_TABLE`` if it doesn't exist."""
+        self.engine.execute(
+            "CREATE TABLE IF NOT EXISTS {} ("
+            "table_name TEXT NOT NULL, "
+            "pk NOT NULL, "
+            "hash TEXT NOT NULL, "
+            "PRIMARY KEY (table_name, pk));".format(ROW_HASHES_TABLE))
+
+    def _drop_row_hashes(self, table_name):
+        """Forgets the row hashes of a table (e.g. when it is replaced)."""
+        if self.engine.execute("SELECT name FROM sqlite_master "
+                               "WHERE name = ?;",
+                               (ROW_HASHES_TABLE,)).fetchone():
+            self.engine.execute(
+                "DELETE FROM {} WHERE table_name = ?;".format(
+                    ROW_HASHES_TABLE),
+                (table_name,))
+
+    def _store_row_hashes(self, table_name, pk_hashes):
+        """Replaces the stored row hashes of a table."""
+        with self.engine.begin() as con:
+            con.execute(
+                "DELETE FROM {} WHERE table_name = ?;".format(
+                    ROW_HASHES_TABLE),
+                (table_name,))
+            con.execute(
+                "INSERT INTO {} (table_name, pk, hash) "
+                "VALUES (?, ?, ?);".format(ROW_HASHES_TABLE),
+                [(table_name, pk, h) for pk, h in pk_hashes])
+
+    @_defer_writeback
     def import_shp(self, filename, table_name, charset="UTF-8", srid=-1,
                    geom_column="geometry", pk_column="PK",
                    geom_type="AUTO", coerce2D=0, compressed=0,
-                   spatial_index=0, text_dates=0):
+                   spatial_index=0, text_dates=0, cluster=False):
         """
         Will import an external Shapfile into an internal Table.
 
@@ -237,6 +702,10 @@ class SpatiaLiteDB(SQLiteDB):
         text_dates: int {0, 1}
             Interpret DBF dates as plaintext or not: 0 by default
             (i.e. as Julian Day).
+        cluster: bool
+            Rewrite the table in Hilbert curve order after importing (see
+            ``cluster_table``); the INTEGER primary key is renumbered in that
+            order. Default False
 
         Returns
         -------
@@ -263,8 +732,115 @@ class SpatiaLiteDB(SQLiteDB):
         if table_name not in self.table_names:
             # TODO: Hopefully this can someday be more helpful
             raise SpatiaLiteError("import failed")
+        if cluster:
+            df = df.append(self.cluster_table(table_name, renumber_pk=True))
+        self._update_layer_stats(table_name, refresh=True)
         return df
 
+    @_defer_writeback
+    def load_file(self, filename, table_name, srid=None, layer=None,
+                  chunksize=10000, if_exists="fail", srid_auth="esri",
+                  spatial_index=0):
+        """
+        Streams the features of any file readable by fiona (GeoPackage,
+        GeoJSON, FlatGeobuf, Shapefile, etc.) into a spatial table, in chunks
+        of ``chunksize`` features, within one transaction.
+
+        Parameters
+        ----------
+        filename: str
+            Path to the file (or dataset) to read
+        table_name: str
+            Name of the table to create (or append to)
+        srid: int
+            Spatial Reference ID of the features. Default: inferred from the
+            source's CRS
+        layer: str or int
+            Layer to read from multi-layer sources. Default: the first
+        chunksize: int
+            Number of features read and inserted at a time. Default 10000
+        if_exists: str ({'fail', 'replace', 'append'}, default 'fail')
+            How to behave if the table already exists.
+
+                * fail: Raise a ValueError.
+                * replace: Drop the table before inserting new values.
+                * append: Insert new values to the existing table.
+
+        srid_auth: str ({'epsg', 'sr-org', 'esri'}, default 'esri')
+            Authority used to retrieve the 'srid' from the web if it is not in
+            the database (ignored when the SRID is inferred).
+        spatial_index: int {0, 1}
+            Build a Spatial Index after loading or not; 0 by default.
+
+        Returns
+        -------
+        DataFrame:
+            DataFrame containing SQL passed and number of inserted features.
+        """
+        # Validate parameters
+        if if_exists not in ("fail", "replace", "append"):
+            raise ValueError("'{}' is not valid for if_exists".format(
+                if_exists))
+        exists = table_name in self.table_names
+        if exists and if_exists == "fail":
+            raise ValueError("Table '{}' already exists.".format(table_name))
+
+        n = 0
+        with fiona.open(filename, layer=layer) as src:
+            if srid is None:
+                srid, srid_auth = _srid_from_wkt(src.crs_wkt)
+                if srid is None:
+                    raise SpatiaLiteError(
+                        "cannot infer the SRID of '{}'".format(filename))
+            if not self.has_srid(srid):
+                self.get_spatial_ref_sys(srid, srid_auth)
+            columns = list(src.schema["properties"].items())
+            geom_type, dims = _fiona_geometry_type(src.schema["geometry"])
+
+            if exists and if_exists == "replace":
+                self.engine.execute("SELECT DropGeoTable(?);", (table_name,))
+                self._drop_layer_stats(table_name)
+                self._drop_row_hashes(table_name)
+                exists = False
+            if not exists:
+                self.engine.execute(
+                    "CREATE TABLE {} (fid INTEGER PRIMARY KEY AUTOINCREMENT"
+                    "{});".format(table_name, "".join(
+                        [', "{}" {}'.format(name, _fiona_column_type(t))
+                         for name, t in columns])))
+                self.engine.execute(
+                    "SELECT AddGeometryColumn(?, 'geometry', ?, ?, ?);",
+                    (table_name, int(srid), geom_type, dims))
+            geom_func = "GeomFromWKB(?, {})".format(int(srid))
+            if geom_type.startswith("MULTI"):
+                geom_func = "CastToMulti({})".format(geom_func)
+            insert_sql = "INSERT INTO {} ({}) VALUES ({});".format(
+                table_name,
+                ", ".join(['"{}"'.format(c) for c, _ in columns] +
+                          ["geometry"]),
+                ", ".join(["?"] * len(columns) + [geom_func]))
+
+            features = iter(src)
+            with self.engine.begin() as con:
+                while True:
+                    chunk = list(itertools.islice(features, chunksize))
+                    if not chunk:
+                        break
+                    geoms = [shape(f["geometry"]) if f["geometry"] else None
+                             for f in chunk]
+                    wkbs = shapely.to_wkb(
+                        geoms, output_dimension=len(dims), flavor="iso")
+                    con.execute(insert_sql, [
+                        tuple([f["properties"][c] for c, _ in columns]) +
+                        (wkb,) for f, wkb in zip(chunk, wkbs)])
+                    n += len(chunk)
+        if spatial_index:
+            self.engine.execute("SELECT CreateSpatialIndex(?, 'geometry');",
+                                (table_name,))
+        self._update_layer_stats(table_name, refresh=not exists)
+        self.schema.refresh()
+        return pd.DataFrame([["load_file()", n]], columns=["SQL", "Result"])
+
     def export_shp(self, table_name, filename, geom_column="geometry",
                    charset="UTF-8", geom_type="AUTO"):
         """
@@ -306,11 +882,17 @@ class SpatiaLiteDB(SQLiteDB):
         if table_name not in self.table_names:
             raise AttributeError("table '{}' not found".format(table_name))
         filename = os.path.splitext(filename)[0].replace("\\", "/")
-        geom_data = self.get_geometry_data(table_name)
         if geom_type == "AUTO":
-            geom_type = GEOM_TYPES[geom_data["geometry_type"]]
-            # TODO: Bug found: "KeyError: 4" -- 4 found with "AUTO" and 4 was
-            # not in GEOM_TYPES; GEOM_TYPES really should be better
+            # Shapefiles hold one of these types (lines and polygons may
+            # have many parts)
+            shp_types = set([
+                {"MULTILINESTRING": "LINESTRING",
+                 "MULTIPOLYGON": "POLYGON"}.get(t, t)
+                for t in self.table_stats(table_name)["geometry_types"]])
+            if len(shp_types) > 1:
+                raise SpatiaLiteError(
+                    "cannot export mixed geometry types: {}".format(
+                        ", ".join(sorted(shp_types))))
         # Execute
         df = self.sql(
             "SELECT ExportSHP(?,?,?,?);",
@@ -341,13 +923,63 @@ class SpatiaLiteDB(SQLiteDB):
         self.engine.execute(sr_data)
         return 1
 
-    def sql(self, q, data=None, union=True, limit=None):
-        """"""
+    def sql(self, q, data=None, union=True, limit=None, to_srid=None):
+        """
+        Executes a query and returns the results as a GeoDataFrame if it
+        contains a 'geometry' column (otherwise as a DataFrame).
+
+        Parameters
+        ----------
+        q: str
+            SQL query
+        data: tuple or dict
+            Query parameters or handlebars values
+        to_srid: int
+            Spatial Reference ID to reproject the geometry to (client-side)
+        """
         # Execute the query using the sql method of the super class
         df = super(SpatiaLiteDB, self).sql(q, data)  # TODO: , union, limit)
+        self._maybe_checkpoint()
         if df.empty:
             return df
+        return self._decode_geometry(df, to_srid)
 
+    def iter_sql(self, q, data=None, chunksize=10000, to_srid=None):
+        """
+        Executes a query and yields the results in chunks of ``chunksize``
+        rows (as GeoDataFrames if they contain a 'geometry' column).
+
+        Parameters
+        ----------
+        q: str
+            SQL query
+        data: tuple or dict
+            Query parameters or handlebars values
+        chunksize: int
+            Maximum number of rows per chunk
+        to_srid: int
+            Spatial Reference ID to reproject the geometry to (client-side)
+        """
+        if isinstance(data, (dict, list)):
+            q, data = self._apply_handlebars(q, data), None
+        if data:
+            result = self.engine.execute(q, data)
+        else:
+            result = self.engine.execute(q)
+        columns = list(result.keys())
+        while True:
+            rows = result.fetchmany(chunksize)
+            if not rows:
+                break
+            df = pd.DataFrame.from_records(
+                [tuple(row) for row in rows], columns=columns)
+            yield self._decode_geometry(df, to_srid)
+
+    def _decode_geometry(self, df, to_srid=None):
+        """
+        Converts the SpatiaLite BLOBs of a DataFrame's 'geometry' column to
+        shapely objects and returns a GeoDataFrame with its crs set.
+        """
         # Post-process the dataframe
         if "geometry" in df.columns:
             # Decode SpatiaLite BLOB and
@@ -376,10 +1008,111 @@ class SpatiaLiteDB(SQLiteDB):
             except TypeError:
                 raise SpatiaLiteError("srid not found: {}".format(srid))
 
+            # Optionally reproject
+            if to_srid is not None and int(to_srid) != int(srid):
+                df["geometry"] = self.transform_geometries(
+                    df["geometry"], srid, to_srid)
+                srid = to_srid
+
             # Set crs attribute of GeoDataFrame
             df.crs = self.get_crs(srid)
         return df
 
+    def get_proj4(self, srid):
+        """
+        Get the proj4text of a spatial reference ID from spatial_ref_sys.
+        """
+        row = self.engine.execute(
+            "SELECT proj4text FROM spatial_ref_sys WHERE srid = ?",
+            (int(srid),)).fetchone()
+        if row is None:
+            raise SpatiaLiteError("srid not found: {}".format(srid))
+        return row[0]
+
+    def transform_geometries(self, geoms, srid, to_srid):
+        """
+        Reprojects shapely geometries from one spatial reference ID to
+        another in bulk using pyproj (see ``utils.transform_geometries``).
+
+        Parameters
+        ----------
+        geoms: array-like
+            shapely geometries
+        srid: int
+            Spatial Reference ID of the geometries
+        to_srid: int
+            Spatial Reference ID to reproject to
+
+        Returns
+        -------
+        numpy.ndarray:
+            Array of reprojected shapely geometries
+        """
+        return transform_geometries(
+            geoms, self.get_proj4(srid), self.get_proj4(to_srid))
+
+    def sql_parallel(self, q, table_name, partition_by="rowid", workers=None,
+                     data=None):
+        """
+        Executes a read-only query in rowid partitions across worker
+        processes and returns the concatenated (ordered) results.
+
+        Each worker opens its own read-only ``mod_spatialite`` connection and
+        decodes the geometry BLOBs to Well-Known Binary, so only WKB is sent
+        back to this process. Only committed data is visible to the workers.
+
+        Parameters
+        ----------
+        q: str
+            SELECT statement containing a ``{{ partition }}`` placeholder in
+            its WHERE clause, e.g.
+            ``SELECT ST_Area(geometry) AS area FROM parcels WHERE {{ partition }}``
+        table_name: str
+            Name of the table scanned by ``partition_by``.
+        partition_by: str
+            Integer column used to split the scan into ranges. Default 'rowid'
+        workers: int
+            Number of worker processes. Default: ``os.cpu_count()``
+        data: dict
+            Other handlebars values used to render the query.
+
+        Returns
+        -------
+        GeoDataFrame or DataFrame
+        """
+        # Validate parameters
+        if self.dbname == ":memory:" or not os.path.exists(self.dbname):
+            raise SpatiaLiteError("sql_parallel requires an on-disk database")
+        if not re.search(r"{{\s*partition\s*}}", q):
+            raise AttributeError("query has no {{ partition }} placeholder")
+        workers = workers or os.cpu_count() or 1
+        lo, hi = self.engine.execute(
+            "SELECT MIN({0}), MAX({0}) FROM {1}".format(
+                partition_by.split(".")[-1], table_name)).fetchone()
+        if lo is None:
+            lo, hi = 0, 0
+
+        # Render one query per rowid range (several per worker to balance)
+        n = min(workers * 4, hi - lo + 1)
+        step = (hi - lo + 1) // n + 1
+        jobs = []
+        for start in range(lo, hi + 1, step):
+            part = dict(data or {})
+            part["partition"] = "{} BETWEEN {} AND {}".format(
+                partition_by, start, start + step - 1)
+            jobs.append((self.dbname, self._extensions,
+                         self._apply_handlebars(q, part)))
+
+        with ProcessPoolExecutor(max_workers=workers) as ex:
+            results = list(ex.map(_sql_partition, jobs))
+        df = pd.concat([r[0] for r in results], ignore_index=True)
+        srids = [r[1] for r in results if r[1] is not None]
+        if "geometry" not in df.columns or not srids:
+            return df
+        # Build the shapely objects from WKB in one pass
+        df["geometry"] = gpd.GeoSeries.from_wkb(df["geometry"])
+        return gpd.GeoDataFrame(df, crs=self.get_crs(srids[0]))
+
     def get_crs(self, srid):
         """
         Get the coordinate reference system (GeoPandas format) for the input
@@ -396,6 +1129,7 @@ class SpatiaLiteDB(SQLiteDB):
             crs = fiona.crs.from_epsg(srid)
         return crs
 
+    @_defer_writeback
     def create_table_as(self, table_name, sql, srid=None, **kwargs):  # TODO: add tests
         """
         Handles ``CREATE TABLE {{table_name}} AS {{select_statement}};`` via
@@ -409,6 +1143,8 @@ class SpatiaLiteDB(SQLiteDB):
             SQL `SELECT` statement used to create a new
         srid: int
             Spatial Reference ID if the resulting table should be spatial
+        Any other kwargs are passed to ``load_geodataframe`` (e.g. 'storage'
+            or 'precision') or ``load_dataframe``.
 
         Returns
         -------
@@ -432,12 +1168,10 @@ class SpatiaLiteDB(SQLiteDB):
              "LEFT JOIN spatial_ref_sys s "
              "ON g.srid=s.srid"))
 
-    def get_geometry_data(self, table_name):
-        """Dictionary of geometry column data by f_table_name."""
-        return self.geometries.set_index("f_table_name").loc[table_name]
-
+    @_defer_writeback
     def alter_geometry(self, table_name, srid="SAME", geom_type="SAME",
-                       dims="SAME", not_null="SAME"):
+                       dims="SAME", not_null="SAME", storage="SAME",
+                       precision=None):
         """
         Replaces an existing table with one with altered geometry column
         properties.
@@ -457,14 +1191,21 @@ class SpatiaLiteDB(SQLiteDB):
             The dimension to cast coordinates to
         not_null: book (default: "SAME")
             WIP - Should inherit the existing table's NOT NULL constraint
+        storage: str ({"compressed", "uncompressed"}, default: "SAME")
+            Rewrite geometries as SpatiaLite compressed (or uncompressed) BLOBs
+        precision: float
+            Grid size to snap coordinates to (SnapToGrid)
         """
         # Validate parameters
-        if set([srid, geom_type, dims, not_null]) == {"SAME"}:
+        if (set([srid, geom_type, dims, not_null, storage]) == {"SAME"} and
+                precision is None):
             raise AttributeError("No changes will be made")
         if table_name not in self.geometries["f_table_name"].tolist():
             raise AttributeError("Not a spatial table: {}".format(table_name))
         if dims not in ("SAME", "XY", "XYZ", "XYM", "XYZM"):
             raise AttributeError("Not a valid dimension")
+        if storage not in ("SAME", "compressed", "uncompressed"):
+            raise AttributeError("Not a valid storage: {}".format(storage))
 
         if srid == "SAME":
             srid = int(self.get_geometry_data(table_name)["srid"])
@@ -475,17 +1216,24 @@ class SpatiaLiteDB(SQLiteDB):
             # NOTE: str format; not an inject threat since srid must be int
             transform = "ST_Transform(geometry, {})".format(srid)
 
+        # Current geometry types and dimensions (falls back on the registered
+        # ones for empty tables)
+        stats = self.table_stats(table_name)
+        types, current_dims = stats["geometry_types"], stats["dims"]
+        if not types:
+            code = int(self.get_geometry_data(table_name)["geometry_type"])
+            types = [GEOM_TYPES.get(code % 1000, "GEOMETRY")]
+            current_dims = [["XY", "XYZ", "XYM", "XYZM"][code // 1000]]
+
         if geom_type == "SAME":  # TODO: geom_type should just be multi/single
-            geom_type = self.sql(
-                "SELECT DISTINCT GeometryType(geometry) AS dims "
-                "FROM {{ table_name }}",
-                data={"table_name": table_name})["dims"].iat[0].split(" ")[0]
+            geom_type = types[0] if len(types) == 1 else "GEOMETRY"
 
         if dims == "SAME":
-            dims = self.sql("SELECT DISTINCT CoordDimension(geometry) AS dims "
-                            "FROM {{ table_name }}",
-                            data={"table_name": table_name})["dims"].iat[0]
+            # Mixed dimensions are cast to the largest one
+            dims = current_dims[-1]
             cast_dims = None
+            if len(current_dims) > 1:
+                cast_dims = "CastTo{0}(geometry)".format(dims)
         else:
             # NOTE: str format; not an injection threat since dims are in list
             cast_dims = "CastTo{0}(geometry)".format(dims)
@@ -493,12 +1241,19 @@ class SpatiaLiteDB(SQLiteDB):
         #if not_null == "SAME":  # TODO:
         not_null = 1
 
-        if transform and cast_dims:
-            funcs = transform.replace("geometry", cast_dims)
-        elif not transform and not cast_dims:
-            funcs = "geometry"  # TODO: geom_type
-        else:
-            funcs = transform or cast_dims
+        # NOTE: str format; not an injection threat since precision is float
+        snap = None
+        if precision is not None:
+            snap = "SnapToGrid(geometry, {!r})".format(float(precision))
+        compress = {
+            "compressed": "CompressGeometry(geometry)",
+            "uncompressed": "UncompressGeometry(geometry)"}.get(storage)
+
+        # Nest the functions: cast, transform, snap then (un)compress
+        funcs = "geometry"  # TODO: geom_type
+        for func in (cast_dims, transform, snap, compress):
+            if func:
+                funcs = func.replace("geometry", funcs)
 
         data = {
             "table_name": table_name,
@@ -508,39 +1263,767 @@ class SpatiaLiteDB(SQLiteDB):
             "not_null": not_null,
             "funcs": funcs}
 
-        # TODO: in future version move this to .sql file in new /scripts folder
-        script = (
-            # CloneTable (try to drop first)
-            "SELECT DropGeoTable('{{ table_name }}_bk')"
-            ";\n"
-            "SELECT "
-            "  CloneTable('main', '{{ table_name }}', '{{ table_name }}_bk', "
-            "  1, '::ignore::geometry');\n"
-            # AddGeometryColumn
-            "SELECT "
-            "  AddGeometryColumn('{{ table_name }}_bk', 'geometry', "
-            "  {{ srid }}, '{{ geom_type }}', '{{ dims }}', {{ not_null }});\n"
-            # Update altered geometry
-            "UPDATE {{ table_name }}_bk "
-            "  SET geometry = (SELECT {{ funcs }} "
-            "  FROM {{ table_name }} "
-            "  WHERE {{ table_name }}_bk.rowid={{ table_name }}.rowid);\n"
-            # Drop original table
-            "SELECT DropGeoTable('{{ table_name }}');\n"
-            # Clone new table into original name
-            "SELECT "
-            "  CloneTable('main', '{{ table_name }}_bk', '{{ table_name }}', "
-            "  1);\n"
-            # Drop _bk table
-            "SELECT DropGeoTable('{{ table_name }}_bk');"
-            "VACUUM;"
-            )
         # TODO: self.sql(scripts.alter_geometry, data)
         try:
-            return self.sql(script, data)
+            r = self.sql(ALTER_GEOMETRY_SCRIPT, data)
         except IntegrityError as e:
-            print(self._apply_handlebars(script, data))
+            print(self._apply_handlebars(ALTER_GEOMETRY_SCRIPT, data))
             raise e
+        # The table was dropped and cloned
+        self._drop_row_hashes(table_name)
+        self._update_layer_stats(table_name, refresh=True)
+        return r
+
+    def nearest(self, table_name, geom_or_table, k=1, max_distance=None,
+                method="auto"):
+        """
+        Finds the ``k`` nearest features of a spatial table to one or many
+        geometries.
+
+        Parameters
+        ----------
+        table_name: str
+            Name of the spatial table to search.
+        geom_or_table: shapely geometry, list, GeoSeries or str
+            Source geometries (in the spatial reference of ``table_name``), or
+            the name of a spatial table whose features are the sources.
+        k: int
+            Number of features to find per source geometry. Default 1
+        max_distance: float
+            Maximum distance (in the units of the table's spatial reference).
+        method: str ({'auto', 'knn', 'strtree'}, default 'auto')
+            How to search.
+
+                * knn: SpatiaLite's KNN2 (or KNN) virtual table, which uses
+                  the table's spatial index.
+                * strtree: client-side shapely STRtree.
+                * auto: 'knn' if the table has a spatial index, otherwise
+                  'strtree'.
+
+        Returns
+        -------
+        GeoDataFrame:
+            The features of ``table_name`` (and their 'target_rowid') with the
+            'source' they were found for (position or index of the source
+            geometries, or rowid of the source table), their 'rank' and
+            'distance'.
+        """
+        geom_data = self.get_geometry_data(table_name)
+        srid = int(geom_data["srid"])
+        # Get source geometries and their ids
+        if isinstance(geom_or_table, str):
+            src = self.sql("SELECT rowid AS source, geometry FROM {{ tbl }}",
+                           data={"tbl": geom_or_table}, to_srid=srid)
+            ids = np.asarray(src["source"]) if not src.empty else []
+            geoms = list(src["geometry"]) if not src.empty else []
+        elif isinstance(geom_or_table, BaseGeometry):
+            ids, geoms = [0], [geom_or_table]
+        else:
+            geoms = list(geom_or_table)
+            if isinstance(geom_or_table, pd.Series):
+                ids = list(geom_or_table.index)
+            else:
+                ids = list(range(len(geoms)))
+        ids = np.asarray(ids)
+
+        knn_table = "KNN2" if "KNN2" in self.table_names else "KNN"
+        if method == "auto":
+            method = "strtree"
+            if (int(geom_data["spatial_index_enabled"]) == 1 and
+                    knn_table in self.table_names):
+                method = "knn"
+        if method not in ("knn", "strtree"):
+            raise AttributeError("Not a valid method: {}".format(method))
+
+        features = None
+        if method == "knn":
+            q = ("SELECT fid, distance FROM {} "
+                 "WHERE f_table_name = ? AND f_geometry_column = 'geometry' "
+                 "AND ref_geometry = GeomFromWKB(?, ?) "
+                 "AND max_items = ?").format(knn_table)
+            if knn_table == "KNN2" and max_distance is not None:
+                q += " AND radius = {:f} AND expand = 0".format(
+                    float(max_distance))
+            elif knn_table == "KNN2":
+                q += " AND expand = 1"
+            pairs = []
+            for i, geom in enumerate(geoms):
+                if geom is None or geom.is_empty:
+                    continue
+                rows = self.engine.execute(
+                    q, (table_name, geom.wkb, srid, int(k))).fetchall()
+                rows = sorted(rows, key=lambda x: x[1])
+                pairs.extend([(i, fid, d, rank)
+                              for rank, (fid, d) in enumerate(rows)])
+            pairs = pd.DataFrame(
+                pairs, columns=["source", "target_rowid", "distance", "rank"])
+        else:
+            features = self.sql(
+                "SELECT rowid AS target_rowid, * FROM {{ tbl }}",
+                data={"tbl": table_name})
+            if features.empty:
+                return features
+            s, t, d, rank = nearest_neighbors(
+                features["geometry"].values, geoms, k, max_distance)
+            pairs = pd.DataFrame({
+                "source": s,
+                "target_rowid": features["target_rowid"].values[t],
+                "distance": d,
+                "rank": rank})
+        pairs["source"] = ids[pairs["source"].values.astype(int)]
+        if max_distance is not None:
+            pairs = pairs[pairs["distance"] <= max_distance]
+
+        # Get the attributes of the matched features
+        if features is None:
+            fids = sorted(set(pairs["target_rowid"].tolist()))
+            chunks = [fids[i:i + 10000] for i in range(0, len(fids), 10000)]
+            features = pd.concat([self.sql(
+                "SELECT rowid AS target_rowid, * FROM {{ tbl }} "
+                "WHERE rowid IN ({{ fids }})",
+                data={"tbl": table_name,
+                      "fids": ",".join([str(int(i)) for i in chunk])})
+                for chunk in chunks] or [pd.DataFrame(
+                    columns=["target_rowid", "geometry"])])
+        df = pairs.merge(features, on="target_rowid", how="left")
+        return gpd.GeoDataFrame(df, geometry="geometry",
+                                crs=self.get_crs(srid))
+
+    @_defer_writeback
+    def cluster_table(self, table_name, method="hilbert", renumber_pk=False,
+                      vacuum=False):
+        """
+        Rewrites a spatial table so that its rows are stored in the order of
+        their position along a Hilbert curve (by MBR center). Spatially close
+        features then share pages, so bbox queries read fewer pages.
+
+        Rowids are reassigned in the new order and the spatial index (if
+        any) is rebuilt.
+
+        Parameters
+        ----------
+        table_name: str
+            Name of the spatial table to cluster
+        method: str ({'hilbert'}, default 'hilbert')
+            Ordering of the rows
+        renumber_pk: bool
+            Allow renumbering an INTEGER PRIMARY KEY column (which is the
+            rowid). Default False
+        vacuum: bool
+            Run VACUUM afterwards to also defragment the file. Default False
+
+        Returns
+        -------
+        DataFrame:
+            DataFrame containing SQL passed and number of rewritten features.
+        """
+        # Validate parameters
+        if method != "hilbert":
+            raise AttributeError("Not a valid method: {}".format(method))
+        if table_name not in self.geometries["f_table_name"].tolist():
+            raise AttributeError("Not a spatial table: {}".format(table_name))
+        spatial_index = int(self.get_geometry_data(
+            table_name)["spatial_index_enabled"]) == 1
+        # An INTEGER PRIMARY KEY is an alias of the rowid
+        info = self.engine.execute(
+            "PRAGMA table_info({})".format(table_name)).fetchall()
+        pks = [i for i in info if i[5]]
+        columns = [i[1] for i in info]
+        if len(pks) == 1 and pks[0][2].upper() == "INTEGER":
+            if not renumber_pk:
+                raise SpatiaLiteError(
+                    "'{}' is the rowid; use renumber_pk=True to cluster "
+                    "'{}'".format(pks[0][1], table_name))
+            columns.remove(pks[0][1])
+        columns = ['"{}"'.format(c.replace('"', '""')) for c in columns]
+
+        # Compute the Hilbert keys from MBR centers
+        rows = self.engine.execute(
+            "SELECT rowid, "
+            "(MbrMinX(geometry) + MbrMaxX(geometry)) / 2.0, "
+            "(MbrMinY(geometry) + MbrMaxY(geometry)) / 2.0 "
+            "FROM {}".format(table_name)).fetchall()
+        if not rows:
+            return pd.DataFrame([["cluster_table()", 0]],
+                                columns=["SQL", "Result"])
+        rowids, x, y = [np.array(i, dtype=float) for i in zip(*rows)]
+        keys = hilbert_keys(x, y)
+
+        with self.engine.begin() as con:
+            if spatial_index:
+                con.execute("SELECT DisableSpatialIndex(?, 'geometry');",
+                            (table_name,))
+                con.execute("DROP TABLE IF EXISTS idx_{}_geometry;".format(
+                    table_name))
+            con.execute("CREATE TEMP TABLE _spatialdb_cluster "
+                        "(rid INTEGER PRIMARY KEY, k INTEGER);")
+            con.execute("INSERT INTO _spatialdb_cluster VALUES (?, ?);",
+                        list(zip(rowids.astype(int).tolist(), keys.tolist())))
+            con.execute(
+                "CREATE TEMP TABLE _spatialdb_clustered AS "
+                "SELECT {cols} FROM {tbl} t "
+                "JOIN _spatialdb_cluster c ON t.rowid = c.rid "
+                "ORDER BY c.k, c.rid;".format(
+                    cols=", ".join(["t." + c for c in columns]),
+                    tbl=table_name))
+            con.execute("DELETE FROM {};".format(table_name))
+            # Restart rowids (AUTOINCREMENT)
+            if con.execute("SELECT name FROM sqlite_master "
+                           "WHERE name = 'sqlite_sequence';").fetchone():
+                con.execute("DELETE FROM sqlite_sequence WHERE name = ?;",
+                            (table_name,))
+            con.execute(
+                "INSERT INTO {tbl} ({cols}) SELECT {cols} "
+                "FROM _spatialdb_clustered ORDER BY rowid;".format(
+                    cols=", ".join(columns), tbl=table_name))
+            con.execute("DROP TABLE _spatialdb_cluster;")
+            con.execute("DROP TABLE _spatialdb_clustered;")
+            if spatial_index:
+                con.execute("SELECT CreateSpatialIndex(?, 'geometry');",
+                            (table_name,))
+        if vacuum:
+            self.engine.execute("VACUUM;")
+        return pd.DataFrame([["cluster_table()", len(rows)]],
+                            columns=["SQL", "Result"])
+
+    @_defer_writeback
+    def build_lod(self, table_name, tolerances, chunksize=10000):
+        """
+        Builds levels of detail of a spatial table: one table of simplified
+        (topology-preserving) geometries per tolerance, named
+        ``<table_name>_lod<n>`` with a 'fid' referencing the rowid of
+        ``table_name``. Each is registered in ``geometry_columns`` (XY) with
+        a spatial index. Existing levels of the table are replaced.
+
+        Levels are only valid for the data they were built from: once
+        ``table_name`` changes (see ``data_version``), ``query_lod`` refuses
+        to use them until they are rebuilt.
+
+        Parameters
+        ----------
+        table_name: str
+            Name of the spatial table
+        tolerances: list
+            Simplification tolerances (in the units of the table's spatial
+            reference)
+        chunksize: int
+            Number of features simplified at a time. Default 10000
+
+        Returns
+        -------
+        DataFrame:
+            The levels of detail of the table (see ``lods``).
+        """
+        # Validate parameters
+        if table_name not in self.geometries["f_table_name"].tolist():
+            raise AttributeError("Not a spatial table: {}".format(table_name))
+        geom_data = self.get_geometry_data(table_name)
+        srid = int(geom_data["srid"])
+        geom_type = GEOM_TYPES.get(
+            int(geom_data["geometry_type"]) % 1000, "GEOMETRY")
+        geom_func = "GeomFromWKB(?, {})".format(srid)
+        if geom_type.startswith("MULTI"):
+            geom_func = "CastToMulti({})".format(geom_func)
+
+        self.drop_lod(table_name)
+        version = repr(self.data_version(table_name))
+        for n, tolerance in enumerate(sorted(tolerances), 1):
+            lod = "{}_lod{}".format(table_name, n)
+            self.engine.execute(
+                "CREATE TABLE {} (fid INTEGER PRIMARY KEY);".format(lod))
+            self.engine.execute(
+                "SELECT AddGeometryColumn(?, 'geometry', ?, ?, 'XY');",
+                (lod, srid, geom_type))
+            with self.engine.begin() as con:
+                last = -2 ** 63
+                while True:
+                    rows = con.execute(
+                        "SELECT rowid, AsBinary(geometry) FROM {} "
+                        "WHERE rowid > ? ORDER BY rowid LIMIT ?;".format(
+                            table_name),
+                        (last, chunksize)).fetchall()
+                    if not rows:
+                        break
+                    fids, wkbs = zip(*rows)
+                    geoms = shapely.simplify(
+                        shapely.from_wkb(list(wkbs)), tolerance,
+                        preserve_topology=True)
+                    con.execute(
+                        "INSERT INTO {} (fid, geometry) "
+                        "VALUES (?, {});".format(lod, geom_func),
+                        list(zip(fids, shapely.to_wkb(
+                            geoms, output_dimension=2, flavor="iso"))))
+                    last = fids[-1]
+                con.execute(
+                    "INSERT INTO {} (f_table_name, lod_table, tolerance, "
+                    "data_version) VALUES (?, ?, ?, ?);".format(LOD_TABLE),
+                    (table_name, lod, float(tolerance), version))
+            self.engine.execute("SELECT CreateSpatialIndex(?, 'geometry');",
+                                (lod,))
+        self.schema.refresh()
+        return self.lods(table_name)
+
+    @_defer_writeback
+    def drop_lod(self, table_name):
+        """Drops the levels of detail of a spatial table (see build_lod)."""
+        for lod in self.lods(table_name)["lod_table"]:
+            self.engine.execute("SELECT DropGeoTable(?);", (lod,))
+            self._drop_layer_stats(lod)
+            self._drop_row_hashes(lod)
+        self.engine.execute(
+            "DELETE FROM {} WHERE f_table_name = ?;".format(LOD_TABLE),
+            (table_name,))
+
+    def lods(self, table_name):
+        """
+        Returns a DataFrame of the levels of detail of a spatial table and
+        their tolerances.
+        """
+        self.engine.execute(
+            "CREATE TABLE IF NOT EXISTS {} ("
+            "f_table_name TEXT NOT NULL, "
+            "lod_table TEXT PRIMARY KEY, "
+            "tolerance DOUBLE NOT NULL, "
+            "data_version TEXT);".format(LOD_TABLE))
+        return self.sql(
+            "SELECT * FROM {} WHERE f_table_name = ? "
+            "ORDER BY tolerance;".format(LOD_TABLE), (table_name,))
+
+    def lod_table(self, table_name, resolution):
+        """
+        Returns the name of the coarsest level of detail of a spatial table
+        whose tolerance does not exceed ``resolution`` (e.g. the ground size
+        of a pixel), or ``table_name`` itself if there is none.
+
+        Raises a SpatiaLiteError if ``table_name`` changed since the levels
+        were built (their 'fid' may no longer match its rowids).
+        """
+        lods = self.lods(table_name)
+        if lods.empty:
+            return table_name
+        lods = lods[lods["tolerance"] <= resolution]
+        if lods.empty:
+            return table_name
+        if lods["data_version"].iat[-1] != repr(
+                self.data_version(table_name)):
+            raise SpatiaLiteError(
+                "levels of detail of '{}' are out of date; rebuild them with "
+                "build_lod".format(table_name))
+        return lods["lod_table"].iat[-1]
+
+    def query_lod(self, table_name, resolution, columns=None, where=None,
+                  bbox=None, data=None, to_srid=None):
+        """
+        Queries a spatial table with the geometry of the level of detail
+        appropriate for ``resolution`` (see ``lod_table``).
+
+        Parameters
+        ----------
+        table_name: str
+            Name of the spatial table
+        resolution: float
+            Display resolution (in the units of the table's spatial
+            reference)
+        columns: list
+            Attribute columns to return. Default: all
+        where: str
+            Optional WHERE clause (attribute columns are prefixed with 't.')
+        bbox: tuple
+            Optional (minx, miny, maxx, maxy) search frame (uses the spatial
+            index of the level of detail)
+        data: tuple
+            Parameters of ``where``
+        to_srid: int
+            Spatial Reference ID to reproject the geometry to (client-side)
+
+        Returns
+        -------
+        GeoDataFrame
+        """
+        lod = self.lod_table(table_name, resolution)
+        if columns is None:
+            columns = [i[1] for i in self.engine.execute(
+                "PRAGMA table_info({})".format(table_name)).fetchall()
+                       if i[1] != "geometry"]
+        if lod == table_name:
+            g = "t"
+            q = "SELECT {} FROM {} t WHERE 1"
+        else:
+            g = "g"
+            q = "SELECT {} FROM {} t JOIN {} g ON g.fid = t.rowid WHERE 1"
+        q = q.format(", ".join(["t.{}".format(c) for c in columns] +
+                               ["{}.geometry".format(g)]), table_name, lod)
+        if bbox is not None:
+            q += " AND " + self._bbox_filter(lod, bbox, g)
+        if where:
+            q += " AND ({})".format(where)
+        return self.sql(q, data, to_srid=to_srid)
+
+    @_defer_writeback
+    def validate_table(self, table_name, repair=True, workers=None,
+                       chunksize=10000):
+        """
+        Checks (and optionally repairs) the geometries of a spatial table in
+        parallel. Chunks of rows are validated with ``shapely.is_valid_reason``
+        and repaired with ``shapely.make_valid`` in worker processes; only
+        the repaired rows are written back (one transaction per chunk).
+
+        Repaired geometries keep only the parts matching the dimension of the
+        table's geometry type (e.g. the polygons of a MULTIPOLYGON table).
+        Rows whose repair doesn't fit the geometry type (e.g. a bowtie in a
+        POLYGON table, which becomes two polygons) are left unchanged and
+        counted as 'unrepairable'.
+
+        Parameters
+        ----------
+        table_name: str
+            Name of the spatial table
+        repair: bool
+            Write repaired geometries back to the table. Default True
+        workers: int
+            Number of worker processes. Default: ``os.cpu_count()``; 1 runs
+            in this process
+        chunksize: int
+            Number of rows per chunk. Default 10000
+
+        Returns
+        -------
+        DataFrame:
+            Number of invalid, repaired and unrepairable geometries by reason
+            (with ``repair=False``, 'unrepairable' still counts the rows a
+            repair would leave unchanged)
+        """
+        # Validate parameters
+        if table_name not in self.geometries["f_table_name"].tolist():
+            raise AttributeError("Not a spatial table: {}".format(table_name))
+        workers = workers or os.cpu_count() or 1
+        geom_data = self.get_geometry_data(table_name)
+        srid = int(geom_data["srid"])
+        geom_type = GEOM_TYPES.get(
+            int(geom_data["geometry_type"]) % 1000, "GEOMETRY")
+        dim = {"POINT": 0, "LINESTRING": 1, "POLYGON": 2}.get(
+            geom_type.replace("MULTI", ""))
+        geom_func = "GeomFromWKB(?, {})".format(srid)
+        if geom_type.startswith("MULTI"):
+            geom_func = "CastToMulti({})".format(geom_func)
+        update_sql = "UPDATE {} SET geometry = {} WHERE rowid = ?;".format(
+            table_name, geom_func)
+
+        def chunks():
+            last = -2 ** 63
+            while True:
+                rows = self.engine.execute(
+                    "SELECT rowid, geometry FROM {} WHERE rowid > ? "
+                    "ORDER BY rowid LIMIT ?;".format(table_name),
+                    (last, chunksize)).fetchall()
+                if not rows:
+                    return
+                last = rows[-1][0]
+                yield ([r[0] for r in rows], [r[1] for r in rows], dim,
+                       geom_type.startswith("MULTI"))
+
+        results = []
+
+        def write(invalid):
+            results.extend(invalid)
+            repaired = [(wkb, rowid) for rowid, _, wkb in invalid
+                        if wkb is not None]
+            if repair and repaired:
+                with self.engine.begin() as con:
+                    con.execute(update_sql, repaired)
+
+        if workers == 1:
+            for job in chunks():
+                write(_validate_chunk(job))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as ex:
+                pending = set()
+                for job in chunks():
+                    pending.add(ex.submit(_validate_chunk, job))
+                    # Bound the number of chunks held in memory
+                    if len(pending) >= workers * 2:
+                        done, pending = wait(
+                            pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            write(future.result())
+                for future in pending:
+                    write(future.result())
+
+        df = pd.DataFrame(results, columns=["rowid", "reason", "wkb"])
+        df["repaired"] = df["wkb"].notnull() & repair
+        df["unrepairable"] = df["wkb"].isnull()
+        return df.groupby("reason").agg(
+            invalid=("rowid", "size"),
+            repaired=("repaired", "sum"),
+            unrepairable=("unrepairable", "sum")).reset_index()
+
+    def _bbox_filter(self, table_name, bbox, alias=None):
+        """
+        Returns a WHERE clause condition selecting the rows of a spatial table
+        intersecting a (minx, miny, maxx, maxy) bbox, using the table's
+        spatial index if it has one.
+        """
+        prefix = "{}.".format(alias) if alias else ""
+        frame = "BuildMbr({:f}, {:f}, {:f}, {:f})".format(
+            *[float(i) for i in bbox])
+        if int(self.get_geometry_data(table_name)["spatial_index_enabled"]):
+            return ("{}rowid IN (SELECT rowid FROM SpatialIndex "
+                    "WHERE f_table_name = '{}' "
+                    "AND search_frame = {})").format(prefix, table_name, frame)
+        return "MbrIntersects({}geometry, {})".format(prefix, frame)
+
+    def aggregate_grid(self, table_name, cell_size, agg=None, bbox=None,
+                       kind="square", chunksize=100000):
+        """
+        Aggregates the features of a spatial table into a grid of square or
+        hexagonal cells (by point, or MBR center, location).
+
+        Square cells are computed in SQL with a GROUP BY; hexagonal cells by
+        streaming the coordinates in chunks and binning them with NumPy.
+        Either way, only the aggregated cells are returned.
+
+        Parameters
+        ----------
+        table_name: str
+            Name of the spatial table
+        cell_size: float
+            Width of the cells (in the units of the table's spatial
+            reference); the distance between opposite sides for hexagons
+        agg: dict
+            Aggregates by column, e.g. ``{"pop": "sum", "age": ["min",
+            "max"]}`` (one or many of sum, count, min, max, mean). A 'count' of
+            features is always included.
+        bbox: tuple
+            Optional (minx, miny, maxx, maxy) extent to aggregate. The grid is
+            aligned on its lower left corner (otherwise on 0, 0).
+        kind: str ({'square', 'hex'}, default 'square')
+            Shape of the cells
+        chunksize: int
+            Number of rows binned at a time for hexagonal cells
+
+        Returns
+        -------
+        GeoDataFrame:
+            One row per non-empty cell with its (i, j) key, 'count',
+            '<column>_<func>' aggregates and geometry.
+        """
+        # Validate parameters
+        if kind not in ("square", "hex"):
+            raise AttributeError("Not a valid kind: {}".format(kind))
+        if table_name not in self.geometries["f_table_name"].tolist():
+            raise AttributeError("Not a spatial table: {}".format(table_name))
+        funcs = {"sum": "SUM", "count": "COUNT", "min": "MIN", "max": "MAX",
+                 "mean": "AVG"}
+        aggs = []
+        for column, func in (agg or {}).items():
+            for f in ([func] if isinstance(func, str) else func):
+                if f not in funcs:
+                    raise AttributeError("Not a valid aggregate: {}".format(f))
+                aggs.append((column, f))
+        geom_data = self.get_geometry_data(table_name)
+        srid = int(geom_data["srid"])
+        if int(geom_data["geometry_type"]) % 1000 == 1:
+            x, y = "ST_X(geometry)", "ST_Y(geometry)"
+        else:
+            x = "(MbrMinX(geometry) + MbrMaxX(geometry)) / 2.0"
+            y = "(MbrMinY(geometry) + MbrMaxY(geometry)) / 2.0"
+        x0, y0 = (float(bbox[0]), float(bbox[1])) if bbox else (0.0, 0.0)
+        where = "geometry IS NOT NULL"
+        if bbox is not None:
+            where += " AND " + self._bbox_filter(table_name, bbox)
+        columns = sorted(set([c for c, _ in aggs]))
+        source = "SELECT {} AS _x, {} AS _y{} FROM {} WHERE {}".format(
+            x, y, "".join([", " + c for c in columns]), table_name, where)
+        names = ["{}_{}".format(c, f) for c, f in aggs]
+
+        if kind == "square":
+            q = ("SELECT CAST(Floor((_x - {x0!r}) / {cs!r}) AS INTEGER) AS i, "
+                 "CAST(Floor((_y - {y0!r}) / {cs!r}) AS INTEGER) AS j, "
+                 "COUNT(*) AS count{aggs} FROM ({source}) "
+                 "GROUP BY i, j ORDER BY i, j").format(
+                     x0=x0, y0=y0, cs=float(cell_size), source=source,
+                     aggs="".join([", {}({}) AS {}".format(funcs[f], c, name)
+                                   for (c, f), name in zip(aggs, names)]))
+            cells = pd.DataFrame.from_records(
+                [tuple(row) for row in self.engine.execute(q).fetchall()],
+                columns=["i", "j", "count"] + names)
+            geometry = shapely.box(
+                x0 + cells["i"] * cell_size, y0 + cells["j"] * cell_size,
+                x0 + (cells["i"] + 1) * cell_size,
+                y0 + (cells["j"] + 1) * cell_size)
+        else:
+            # Partial aggregates are combined chunk by chunk
+            partial = {"count": "sum"}
+            for c, f in aggs:
+                for p in (["sum", "count"] if f == "mean" else [f]):
+                    partial["{}_{}".format(c, p)] = {
+                        "count": "sum"}.get(p, p)
+            cells = None
+            result = self.engine.execute(source)
+            while True:
+                rows = result.fetchmany(chunksize)
+                if not rows:
+                    break
+                chunk = pd.DataFrame.from_records(
+                    [tuple(row) for row in rows],
+                    columns=["_x", "_y"] + columns)
+                chunk["i"], chunk["j"] = hex_bin(
+                    chunk["_x"].values - x0, chunk["_y"].values - y0,
+                    cell_size)
+                groups = chunk.groupby(["i", "j"])
+                part = groups.size().to_frame("count")
+                for name in partial:
+                    if name == "count":
+                        continue
+                    column, p = name.rsplit("_", 1)
+                    part[name] = getattr(groups[column], p)()
+                cells = part if cells is None else pd.concat(
+                    [cells, part]).groupby(level=["i", "j"]).agg(partial)
+            if cells is None:
+                cells = pd.DataFrame(columns=list(partial), index=(
+                    pd.MultiIndex.from_arrays([[], []], names=["i", "j"])))
+            for c, f in aggs:
+                if f == "mean":
+                    cells["{}_mean".format(c)] = (cells["{}_sum".format(c)] /
+                                                  cells["{}_count".format(c)])
+            cells = cells.reset_index()[["i", "j", "count"] + names]
+            geometry = hex_polygons(cells["i"].values, cells["j"].values,
+                                    cell_size, x0, y0)
+        return gpd.GeoDataFrame(cells, geometry=np.asarray(geometry),
+                                crs=self.get_crs(srid))
+
+    def data_version(self, table_name):
+        """
+        Returns a value that changes whenever the data of a spatial table
+        changes, from any connection: the last insert, update and delete
+        timestamps of ``geometry_columns_time``, the largest rowid and the
+        row count. Read-only; the table's schema is left untouched.
+
+        The timestamps have millisecond resolution: inserts and deletes are
+        also caught by the rowid and row count, but an update made within
+        the same millisecond as a previous call goes unnoticed.
+        """
+        with self.engine.begin() as con:
+            return _data_version(con, table_name)
+
+    def table_stats(self, table_name, refresh=False):
+        """
+        Returns the statistics of a spatial table, kept in the
+        ``LAYER_STATS_TABLE``: row count, extent, geometry types and
+        coordinate dimensions.
+
+        Statistics are brought up to date by the loading methods (scanning
+        only the rows they inserted or updated). Changes made otherwise are
+        detected with ``data_version`` and trigger a full scan on the next
+        call. Nothing is written when the stored statistics are current, and
+        read-only databases get freshly computed (unstored) statistics.
+
+        Parameters
+        ----------
+        table_name: str
+            Name of the spatial table
+        refresh: bool
+            Recompute the statistics with a full scan. Default False
+
+        Returns
+        -------
+        dict:
+            'row_count', 'geometry_count' (non-NULL), 'extent' (minx, miny,
+            maxx, maxy; None if empty), 'geometry_types' and 'dims'
+        """
+        try:
+            with self.engine.begin() as con:
+                stats = _update_layer_stats(con, table_name, refresh)
+        except OperationalError as e:
+            if "readonly" not in str(e):
+                raise
+            with self.engine.begin() as con:
+                stats = _update_layer_stats(con, table_name, refresh,
+                                            store=False)
+        # GeometryType returns e.g. 'POLYGON', 'POLYGON Z' or 'POLYGON XYZM'
+        suffixes = {"": "XY", "Z": "XYZ", "M": "XYM", "ZM": "XYZM"}
+        types, dims = set(), set()
+        for name in stats["classes"]:
+            parts = name.split(" ")
+            types.add(parts[0])
+            dims.add(suffixes.get(" ".join(parts[1:]), " ".join(parts[1:])))
+        return {
+            "row_count": stats["row_count"],
+            "geometry_count": sum(stats["classes"].values()),
+            "extent": tuple(stats["extent"]) if stats["extent"] else None,
+            "geometry_types": sorted(types),
+            "dims": sorted(dims, key=lambda d: (len(d), d))}
+
+    def _update_layer_stats(self, table_name, refresh=False):
+        """Brings the statistics of a table up to date (see table_stats)."""
+        with self.engine.begin() as con:
+            _update_layer_stats(con, table_name, refresh)
+
+    def _drop_layer_stats(self, table_name):
+        """Forgets the statistics of a table (e.g. before it is replaced)."""
+        if self.engine.execute("SELECT name FROM sqlite_master "
+                               "WHERE name = ?;",
+                               (LAYER_STATS_TABLE,)).fetchone():
+            self.engine.execute(
+                "DELETE FROM {} WHERE table_name = ?;".format(
+                    LAYER_STATS_TABLE),
+                (table_name.lower(),))
+
+    def lookup_index(self, table_name, columns=None, auto_refresh=True):
+        """
+        Loads a spatial table into an in-memory ``LookupIndex`` for fast
+        (vectorized) point-in-polygon lookups.
+
+        Parameters
+        ----------
+        table_name: str
+            Name of the spatial table
+        columns: list
+            Attribute columns returned by lookups. Default: all
+        auto_refresh: bool
+            Reload the table before a lookup if its data changed. Default True
+
+        Returns
+        -------
+        LookupIndex
+        """
+        return LookupIndex(self, table_name, columns, auto_refresh)
+
+    def writer(self, table_name, batch_size=5000, flush_interval=0.5,
+               max_pending=1000, validate=False, wal=False):
+        """
+        Starts a ``BatchWriter`` appending GeoDataFrames to an existing
+        spatial table from a background thread. Appends from any number of
+        threads are queued and coalesced into batched transactions on a
+        single dedicated connection.
+
+        Parameters
+        ----------
+        table_name: str
+            Name of the spatial table
+        batch_size: int
+            Number of rows above which a batch is committed. Default 5000
+        flush_interval: float
+            Maximum number of seconds a row waits before being committed.
+            Default 0.5
+        max_pending: int
+            Number of queued appends above which ``append`` blocks
+            (backpressure). Default 1000
+        validate: bool
+            Make geometries valid (client-side) before queuing them
+        wal: bool
+            Switch the database to WAL journal mode so readers are not
+            blocked by the writer's transactions. Default False
+
+        Returns
+        -------
+        BatchWriter
+        """
+        if self.dbname == ":memory:":
+            raise AttributeError(
+                "A writer needs a database file (not ':memory:')")
+        return BatchWriter(self, table_name, batch_size, flush_interval,
+                           max_pending, validate, wal)
 
     def __str__(self):
         return "SpatialDB[SQLite/SpatiaLite] > {dbname}".format(
@@ -550,6 +2033,612 @@ class SpatiaLiteDB(SQLiteDB):
         return self.__str__()
 
 
+class LookupIndex(object):
+    """
+    In-memory lookup index of a spatial table: an STRtree of its (prepared)
+    geometries answering batch ``contains``/``intersects`` queries.
+
+    Parameters
+    ----------
+    db: SpatiaLiteDB
+        Database containing the table
+    table_name: str
+        Name of the spatial table
+    columns: list
+        Attribute columns returned by lookups. Default: all
+    auto_refresh: bool
+        Reload the table before a lookup if its data changed. Default True
+    """
+    def __init__(self, db, table_name, columns=None, auto_refresh=True):
+        self.db = db
+        self.table_name = table_name
+        self.columns = columns
+        self.auto_refresh = auto_refresh
+        self.version = None
+        self.refresh()
+
+    def refresh(self, force=False):
+        """
+        Reloads the table if its data version changed (or if ``force``).
+        Returns True if the table was reloaded.
+        """
+        version = self.db.data_version(self.table_name)
+        if not force and self.version is not None and version == self.version:
+            return False
+        columns = "*" if self.columns is None else ", ".join(
+            list(self.columns) + ["geometry"])
+        df = self.db.sql("SELECT {} FROM {{{{ tbl }}}}".format(columns),
+                         data={"tbl": self.table_name})
+        if df.empty:
+            self.geometries = np.array([], dtype=object)
+            self.attributes = pd.DataFrame(
+                columns=[c for c in df.columns if c != "geometry"])
+        else:
+            self.geometries = np.asarray(df["geometry"].values, dtype=object)
+            self.attributes = pd.DataFrame(
+                df.drop("geometry", axis=1)).reset_index(drop=True)
+        shapely.prepare(self.geometries)
+        self.tree = shapely.STRtree(self.geometries)
+        self.version = version
+        return True
+
+    def query(self, x, y=None, predicate="contains", all_matches=False):
+        """
+        Finds the features matching each point.
+
+        Parameters
+        ----------
+        x: array-like
+            x coordinates, or shapely points if ``y`` is None
+        y: array-like
+            y coordinates
+        predicate: str ({'contains', 'intersects'}, default 'contains')
+            Spatial relationship between the features and the points
+        all_matches: bool
+            Return every matching feature rather than the first. Default False
+
+        Returns
+        -------
+        DataFrame:
+            The attributes of the first match of each point (NaN if none),
+            indexed by point position; with ``all_matches``, one row per
+            match with the point position in a 'point' column.
+        """
+        if predicate not in ("contains", "intersects"):
+            raise AttributeError("Not a valid predicate: {}".format(predicate))
+        if self.auto_refresh:
+            self.refresh()
+        if y is None:
+            points = np.asarray(x, dtype=object)
+        else:
+            points = shapely.points(np.asarray(x), np.asarray(y))
+        # Bounding box candidates, then the (prepared) predicate
+        src, tgt = self.tree.query(points)
+        matches = getattr(shapely, predicate)(
+            self.geometries[tgt], points[src])
+        src, tgt = src[matches], tgt[matches]
+        order = np.lexsort((tgt, src))
+        src, tgt = src[order], tgt[order]
+        if not all_matches:
+            first = np.r_[True, src[1:] != src[:-1]][:len(src)]
+            src, tgt = src[first], tgt[first]
+        result = self.attributes.iloc[tgt].reset_index(drop=True)
+        result.insert(0, "point", src)
+        if all_matches:
+            return result
+        return result.set_index("point").reindex(range(len(points)))
+
+    def contains(self, x, y=None, all_matches=False):
+        """Features containing each point (see ``query``)."""
+        return self.query(x, y, "contains", all_matches)
+
+    def intersects(self, x, y=None, all_matches=False):
+        """Features intersecting each point (see ``query``)."""
+        return self.query(x, y, "intersects", all_matches)
+
+    def __len__(self):
+        return len(self.geometries)
+
+
+class BatchWriter(object):
+    """
+    Background writer of a spatial table (see ``SpatiaLiteDB.writer``).
+
+    The table's metadata (SRID, geometry type) is read once. Appends are
+    converted to parameter rows in the calling thread and queued; a single
+    thread owning its own connection commits them in batches of up to
+    ``batch_size`` rows, or every ``flush_interval`` seconds.
+
+    Can be used as a context manager (``close`` on exit).
+    """
+    def __init__(self, db, table_name, batch_size=5000, flush_interval=0.5,
+                 max_pending=1000, validate=False, wal=False):
+        if table_name not in db.geometries["f_table_name"].tolist():
+            raise AttributeError("Not a spatial table: {}".format(table_name))
+        geom_data = db.get_geometry_data(table_name)
+        self.dbname = db.dbname
+        self.extensions = db._extensions
+        self.table_name = table_name
+        self.srid = int(geom_data["srid"])
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.validate = validate
+        self.wal = wal
+        self._geom_func = "GeomFromWKB(?, {})".format(self.srid)
+        if int(geom_data["geometry_type"]) % 1000 in (4, 5, 6):
+            self._geom_func = "CastToMulti({})".format(self._geom_func)
+        self._statements = {}
+        self._queue = queue.Queue(max_pending)
+        self._error = None
+        self._closed = False
+        self._stats = {"appends": 0, "rows": 0, "batches": 0,
+                       "write_time": 0.0, "latency_total": 0.0,
+                       "latency_max": 0.0}
+        self._started = time.time()
+        self._thread = threading.Thread(target=self._run, name="BatchWriter")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def append(self, gdf, block=True, timeout=None):
+        """
+        Queues the rows of a GeoDataFrame (geometries in the table's SRID).
+        Blocks while ``max_pending`` appends are queued, unless ``block`` is
+        False (or ``timeout`` expires), in which case ``queue.Full`` is raised.
+        """
+        self._check()
+        if self.validate:
+            gdf = gdf.copy()
+            gdf["geometry"] = shapely.make_valid(np.asarray(gdf.geometry))
+        columns = tuple(c for c in gdf.columns if c != "geometry")
+        rows = _row_values(gdf, list(columns))
+        if rows:
+            self._queue.put((columns, rows, time.time()), block, timeout)
+
+    def flush(self):
+        """
+        Waits until every queued row is committed.
+        """
+        self._queue.join()
+        self._check()
+
+    def close(self):
+        """
+        Commits the queued rows and stops the writer's thread.
+        """
+        if self._closed:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._closed = True
+        # Only a pending write error is raised
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def stats(self):
+        """
+        Dictionary of the writer's activity: appends, rows and batches
+        committed, pending appends, mean/max latency (seconds between
+        ``append`` and commit) and throughput (rows per second, overall and
+        while writing).
+        """
+        s = dict(self._stats)
+        elapsed = time.time() - self._started
+        return {
+            "appends": s["appends"],
+            "rows": s["rows"],
+            "batches": s["batches"],
+            "pending": self._queue.qsize(),
+            "latency_mean": (s["latency_total"] / s["appends"]
+                             if s["appends"] else 0.0),
+            "latency_max": s["latency_max"],
+            "rows_per_second": s["rows"] / elapsed if elapsed else 0.0,
+            "write_rows_per_second": (s["rows"] / s["write_time"]
+                                      if s["write_time"] else 0.0)}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _check(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+        if self._closed:
+            raise AttributeError("Writer is closed")
+
+    def _statement(self, columns):
+        if columns not in self._statements:
+            self._statements[columns] = (
+                "INSERT INTO {} ({}) VALUES ({});").format(
+                self.table_name,
+                ", ".join(list(columns) + ["geometry"]),
+                ", ".join(["?"] * len(columns) + [self._geom_func]))
+        return self._statements[columns]
+
+    def _run(self):
+        con = error = None
+        try:
+            con = _connect_spatialite(self.dbname, self.extensions)
+            if self.wal:
+                con.execute("PRAGMA journal_mode = WAL;")
+        except Exception as e:
+            # Every batch fails with this error; the queue is still consumed
+            # so that flush and close raise it rather than block
+            error = self._error = e
+        try:
+            stop = False
+            while not stop:
+                item = self._queue.get()
+                if item is None:
+                    self._queue.task_done()
+                    break
+                batch = [item]
+                size = len(item[1])
+                deadline = item[2] + self.flush_interval
+                # Coalesce appends until the batch is full or due
+                while size < self.batch_size:
+                    try:
+                        item = self._queue.get(
+                            timeout=max(deadline - time.time(), 0))
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        stop = True
+                        self._queue.task_done()
+                        break
+                    batch.append(item)
+                    size += len(item[1])
+                try:
+                    if error is None:
+                        self._write(con, batch)
+                    else:
+                        self._error = error
+                finally:
+                    for _ in batch:
+                        self._queue.task_done()
+        finally:
+            if con is not None:
+                con.close()
+
+    def _write(self, con, batch):
+        start = time.time()
+        try:
+            with con:
+                for columns, rows in itertools.groupby(
+                        batch, key=lambda item: item[0]):
+                    con.executemany(self._statement(columns), [
+                        row for item in rows for row in item[1]])
+                _update_layer_stats(con, self.table_name)
+        except Exception as e:
+            # Raised to the caller on its next append/flush
+            self._error = e
+            return
+        end = time.time()
+        latencies = [end - item[2] for item in batch]
+        self._stats["appends"] += len(batch)
+        self._stats["rows"] += sum([len(item[1]) for item in batch])
+        self._stats["batches"] += 1
+        self._stats["write_time"] += end - start
+        self._stats["latency_total"] += sum(latencies)
+        self._stats["latency_max"] = max(
+            [self._stats["latency_max"]] + latencies)
+
+
+def _srid_from_wkt(wkt):
+    """
+    Returns the SRID and (lowercase) authority of a CRS given as WKT, or
+    (None, None) if it has no known authority code.
+    """
+    if not wkt:
+        return None, None
+    authority = CRS.from_wkt(wkt).to_authority(min_confidence=70)
+    if authority is None:
+        return None, None
+    return int(authority[1]), authority[0].lower()
+
+
+def _fiona_geometry_type(geom_type):
+    """
+    Returns the SpatiaLite geometry type and dimensions of a fiona schema
+    geometry type (e.g. '3D Polygon'). Polygons and LineStrings are
+    promoted to Multi-types since formats like Shapefile mix both.
+    """
+    dims = "XY"
+    if geom_type and geom_type.startswith("3D "):
+        geom_type, dims = geom_type[3:], "XYZ"
+    geom_type = {
+        "Point": "POINT",
+        "LineString": "MULTILINESTRING",
+        "Polygon": "MULTIPOLYGON",
+        "MultiPoint": "MULTIPOINT",
+        "MultiLineString": "MULTILINESTRING",
+        "MultiPolygon": "MULTIPOLYGON",
+        "GeometryCollection": "GEOMETRYCOLLECTION"}.get(geom_type, "GEOMETRY")
+    return geom_type, dims
+
+
+def _fiona_column_type(field_type):
+    """Returns the SQLite type of a fiona schema field (e.g. 'str:80')."""
+    return {
+        "int": "INTEGER",
+        "int32": "INTEGER",
+        "int64": "INTEGER",
+        "float": "DOUBLE",
+        "str": "TEXT",
+        "bool": "INTEGER",
+        "date": "DATE",
+        "datetime": "DATETIME",
+        "time": "TEXT",
+        "bytes": "BLOB"}.get(field_type.split(":")[0], "TEXT")
+
+
+def _data_version(con, table_name):
+    """
+    Returns the ``data_version`` of a spatial table using ``con`` (a
+    SQLAlchemy or DB-API connection): its ``geometry_columns_time``
+    timestamps (last insert, update and delete) followed by its largest
+    rowid and row count. Nothing is written.
+    """
+    times = con.execute(
+        "SELECT last_insert, last_update, last_delete "
+        "FROM geometry_columns_time "
+        "WHERE Lower(f_table_name) = Lower(?)", (table_name,)).fetchone()
+    if times is None:
+        raise AttributeError("Not a spatial table: {}".format(table_name))
+    max_rowid, row_count = con.execute(
+        "SELECT MAX(rowid), COUNT(*) FROM {};".format(table_name)).fetchone()
+    return tuple(times) + (max_rowid or 0, row_count)
+
+
+def _layer_stats(con, table_name, where="", params=()):
+    """
+    Aggregates the rows of a spatial table (optionally filtered by a WHERE
+    clause) into statistics: a dictionary of the 'row_count', the number of
+    geometries of each GeometryType ('classes') and the 'extent'.
+    """
+    rows = con.execute(
+        "SELECT GeometryType(geometry), COUNT(*), "
+        "Min(MbrMinX(geometry)), Min(MbrMinY(geometry)), "
+        "Max(MbrMaxX(geometry)), Max(MbrMaxY(geometry)) "
+        "FROM {} {} GROUP BY 1;".format(table_name, where), params).fetchall()
+    stats = {"row_count": 0, "classes": {}, "extent": None}
+    for name, count, min_x, min_y, max_x, max_y in rows:
+        stats["row_count"] += count
+        if name is not None:
+            stats["classes"][name] = count
+            stats["extent"] = _union_extent(
+                stats["extent"], [min_x, min_y, max_x, max_y])
+    return stats
+
+
+def _union_extent(a, b):
+    """Returns the union of two (minx, miny, maxx, maxy) extents (or None)."""
+    if not a or a[0] is None:
+        return list(b) if b and b[0] is not None else None
+    if not b or b[0] is None:
+        return list(a)
+    return [min(a[0], b[0]), min(a[1], b[1]),
+            max(a[2], b[2]), max(a[3], b[3])]
+
+
+def _merge_layer_stats(stats, delta, sign=1):
+    """Adds (or, with ``sign=-1``, removes the counts of) ``delta``."""
+    classes = dict(stats["classes"])
+    for name, count in delta["classes"].items():
+        classes[name] = classes.get(name, 0) + sign * count
+    merged = {
+        "row_count": stats["row_count"] + sign * delta["row_count"],
+        "classes": dict([(k, v) for k, v in classes.items() if v > 0]),
+        "extent": stats["extent"]}
+    if sign > 0:
+        merged["extent"] = _union_extent(stats["extent"], delta["extent"])
+    return merged
+
+
+def _stored_layer_stats(con, table_name):
+    """
+    Returns the stored statistics of a table and its ``data_version`` when
+    they were computed (or None).
+    """
+    if not con.execute("SELECT name FROM sqlite_master WHERE name = ?;",
+                       (LAYER_STATS_TABLE,)).fetchone():
+        return None
+    row = con.execute(
+        "SELECT row_count, min_x, min_y, max_x, max_y, classes, "
+        "data_version FROM {} WHERE table_name = ?;".format(
+            LAYER_STATS_TABLE), (table_name.lower(),)).fetchone()
+    if row is None:
+        return None
+    stats = {"row_count": row[0],
+             "classes": json.loads(row[5]),
+             "extent": list(row[1:5]) if row[1] is not None else None}
+    return stats, tuple(json.loads(row[6]))
+
+
+def _store_layer_stats(con, table_name, stats, version):
+    """Stores the statistics of a table in the ``LAYER_STATS_TABLE``."""
+    con.execute(
+        "CREATE TABLE IF NOT EXISTS {} ("
+        "table_name TEXT PRIMARY KEY, "
+        "row_count INTEGER, "
+        "geometry_count INTEGER, "
+        "min_x REAL, min_y REAL, max_x REAL, max_y REAL, "
+        "classes TEXT, "
+        "data_version TEXT);".format(LAYER_STATS_TABLE))
+    con.execute(
+        "INSERT OR REPLACE INTO {} VALUES "
+        "(?, ?, ?, ?, ?, ?, ?, ?, ?);".format(LAYER_STATS_TABLE),
+        (table_name.lower(), stats["row_count"],
+         sum(stats["classes"].values())) +
+        tuple(stats["extent"] or [None] * 4) +
+        (json.dumps(stats["classes"], sort_keys=True), json.dumps(version)))
+
+
+def _pk_layer_stats(con, table_name, pk_column, pks):
+    """
+    Statistics (see ``_layer_stats``) of the rows of a table whose
+    ``pk_column`` is in ``pks``.
+    """
+    con.execute("CREATE TEMP TABLE IF NOT EXISTS _spatialdb_pks "
+                "(pk PRIMARY KEY);")
+    con.execute("DELETE FROM _spatialdb_pks;")
+    if pks:
+        con.execute("INSERT INTO _spatialdb_pks VALUES (?);",
+                    [(pk,) for pk in pks])
+    return _layer_stats(
+        con, table_name,
+        "WHERE {} IN (SELECT pk FROM _spatialdb_pks)".format(pk_column))
+
+
+def _current_layer_stats(con, table_name):
+    """
+    Returns the stored statistics of a table if they are up to date (without
+    scanning it), otherwise None.
+    """
+    stored = _stored_layer_stats(con, table_name)
+    if stored is None:
+        return None
+    stats, version = stored
+    if version == _data_version(con, table_name):
+        return stats
+    return None
+
+
+def _update_layer_stats(con, table_name, refresh=False, store=True):
+    """
+    Brings the ``LAYER_STATS_TABLE`` row of a spatial table up to date using
+    ``con`` (a SQLAlchemy or DB-API connection), within the caller's
+    transaction, and returns the statistics (see ``_layer_stats``).
+
+    The row records the table's ``data_version``. If only inserts happened
+    since, the rows with a larger rowid are aggregated and merged (provided
+    they account for the new row count); after any update or delete, the
+    whole table is scanned again. Nothing is written if the row is current
+    (or if ``store`` is False).
+    """
+    version = _data_version(con, table_name)
+    stored = None if refresh else _stored_layer_stats(con, table_name)
+    stats = None
+    if stored is not None:
+        old, old_version = stored
+        if old_version == version:
+            return old
+        # Update and delete timestamps unchanged: inserts only
+        if (old_version[1:3] == version[1:3] and
+                version[3] >= old_version[3]):
+            delta = _layer_stats(con, table_name, "WHERE rowid > ?",
+                                 (old_version[3],))
+            # Inserts below the largest rowid require a full scan
+            if delta["row_count"] == version[4] - old_version[4]:
+                stats = _merge_layer_stats(old, delta)
+    if stats is None:
+        stats = _layer_stats(con, table_name)
+    if store:
+        _store_layer_stats(con, table_name, stats, version)
+    return stats
+
+
+def _connect_spatialite(dbname, extensions, readonly=False):
+    """
+    Opens a new DB-API connection to ``dbname`` with ``extensions`` (those of
+    the ``SpatiaLiteDB``, e.g. mod_spatialite) loaded.
+    """
+    if readonly:
+        uri = "file:{}?mode=ro".format(
+            pathname2url(os.path.abspath(dbname)))
+        con = sqlite3.connect(uri, uri=True)
+    else:
+        con = sqlite3.connect(dbname)
+    try:
+        con.enable_load_extension(True)
+        for extension in extensions:
+            con.load_extension(extension)
+    except Exception:
+        con.close()
+        raise
+    return con
+
+
+def _sql_partition(job):
+    """
+    Worker for ``SpatiaLiteDB.sql_parallel``. Executes one partition of a
+    query and returns it as a DataFrame (geometry as WKB) and its SRID.
+    """
+    dbname, extensions, q = job
+    con = _connect_spatialite(dbname, extensions, readonly=True)
+    try:
+        cur = con.execute(q)
+        columns = [c[0] for c in cur.description]
+        df = pd.DataFrame.from_records(cur.fetchall(), columns=columns)
+    finally:
+        con.close()
+    srid = None
+    if "geometry" in df.columns:
+        blobs = [SpatiaLiteBlobElement(x) if x else None
+                 for x in df["geometry"]]
+        srid = next((int(b.srid) for b in blobs if b is not None), None)
+        df["geometry"] = [b.wkb if b is not None else None for b in blobs]
+    return df, srid
+
+
+def _validate_chunk(job):
+    """
+    Worker for ``SpatiaLiteDB.validate_table``. Returns the rowid, reason
+    and repaired geometry (ISO WKB, None if the repair doesn't fit the
+    column's geometry type) of each invalid geometry of a chunk.
+    """
+    rowids, blobs, dim, multi = job
+    geoms = shapely.from_wkb(
+        [SpatiaLiteBlobElement(b).wkb if b else None for b in blobs])
+    reasons = shapely.is_valid_reason(geoms)
+    invalid = []
+    for i in np.flatnonzero(
+            [r is not None and r != "Valid Geometry" for r in reasons]):
+        # Drop the location, e.g. 'Self-intersection[1 2]'
+        reason = re.sub(r"\[.*\]$", "", reasons[i])
+        wkb = None
+        fixed = shapely.make_valid(geoms[i])
+        if dim is not None:
+            parts = shapely.get_parts(fixed)
+            parts = parts[shapely.get_dimensions(parts) == dim]
+            fixed = shapely.union_all(parts) if len(parts) else None
+        # A single-type column (e.g. POLYGON) can't hold a multi-part repair
+        if (fixed is not None and not fixed.is_empty and
+                (multi or dim is None or
+                 shapely.get_num_geometries(fixed) == 1)):
+            if not multi and fixed.geom_type.startswith("Multi"):
+                fixed = shapely.get_geometry(fixed, 0)
+            wkb = shapely.to_wkb(fixed, flavor="iso")
+        invalid.append((rowids[i], reason, wkb))
+    return invalid
+
+
+def _row_values(gdf, columns):
+    """
+    Returns a list of parameter tuples (``columns`` followed by the geometry
+    as Well-Known Binary) with NaN values replaced by None.
+    """
+    attrs = gdf[columns].astype(object)
+    attrs = attrs.where(pd.notnull(attrs), None)
+    wkbs = [g.wkb if g is not None else None for g in gdf["geometry"]]
+    return [row + (wkb,) for row, wkb in zip(
+        attrs.itertuples(index=False, name=None), wkbs)]
+
+
+def _row_hashes(gdf):
+    """
+    Returns a content hash (attributes + WKB) for each row of a GeoDataFrame.
+    """
+    columns = [c for c in gdf.columns if c != "geometry"]
+    return [
+        hashlib.sha1(repr(row[:-1]).encode("utf8") + (row[-1] or b"")
+                     ).hexdigest()
+        for row in _row_values(gdf, columns)]
+
+
 # TODO: SQL function?
 '''
 def RegisterSpatialView(self, view_name, view_geometry, f_table_name,
@@ -576,7 +2665,7 @@ def RegisterSpatialView(self, view_name, view_geometry, f_table_name,
     return code
 '''
 
-# TODO: make SpatialDB superclass or abstract class(?)
+# TODO: PostGIS backend
 '''
 class PostGISDB(SpatialDB):
     def __init__(self):
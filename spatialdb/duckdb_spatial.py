@@ -0,0 +1,255 @@
+"""
+DuckDB (spatial extension) backend for analytical queries.
+
+Requires the ``duckdb`` package; the ``spatial`` extension is installed on
+first connection.
+"""
+
+from __future__ import unicode_literals
+
+import re
+import sqlite3
+
+import duckdb
+import fiona
+import geopandas as gpd
+import pandas as pd
+import shapely.wkt
+
+from .base import GEOM_TYPES, SpatialDB
+
+# Table describing the spatial tables (DuckDB geometries carry no SRID)
+GEOMETRY_COLUMNS_TABLE = "spatialdb_geometry_columns"
+
+
+class DuckDBSpatialDB(SpatialDB):
+    """
+    Utility for running analytical spatial queries on an embedded DuckDB
+    database with the same API as ``SpatiaLiteDB``.
+
+    Parameters
+    ----------
+    dbname: str
+        Path to DuckDB database or ":memory:" for in-memory database
+    echo: bool
+        Whether or not to repeat queries and messages back to user
+    threads: int
+        Number of threads used by DuckDB. Default: all cores
+    """
+    def __init__(self, dbname=":memory:", echo=False, threads=None):
+        self.dbname = dbname
+        self.echo = echo
+        self.con = duckdb.connect(dbname)
+        self.con.execute("INSTALL spatial; LOAD spatial;")
+        if threads is not None:
+            self.con.execute("SET threads = {}".format(int(threads)))
+        self.con.execute(
+            "CREATE TABLE IF NOT EXISTS {} ("
+            "f_table_name VARCHAR PRIMARY KEY, "
+            "f_geometry_column VARCHAR, "
+            "geometry_type VARCHAR, "
+            "srid INTEGER, "
+            "proj4text VARCHAR);".format(GEOMETRY_COLUMNS_TABLE))
+
+    @property
+    def table_names(self):
+        """List of the tables and views in the database."""
+        return [i[0] for i in self.con.execute(
+            "SELECT table_name FROM information_schema.tables").fetchall()]
+
+    @property
+    def geometries(self):
+        """
+        Returns a DataFrame of the spatial tables, their geometry type and
+        spatial reference.
+        """
+        return self.sql("SELECT * FROM {}".format(GEOMETRY_COLUMNS_TABLE))
+
+    def sql(self, q, data=None, srid=None):
+        """
+        Executes a query and returns the results as a GeoDataFrame if it
+        contains a 'geometry' column (otherwise as a DataFrame).
+
+        Parameters
+        ----------
+        q: str
+            SQL query
+        data: list or dict
+            Query parameters
+        srid: int
+            Spatial Reference ID of the resulting geometry. By default, the
+            SRID of the (single) spatial table referenced by the query.
+        """
+        if self.echo:
+            print(q)
+        rel = self.con.sql(q, params=data)
+        # Statements other than queries are executed immediately
+        if rel is None:
+            return pd.DataFrame()
+        types = dict(zip(rel.columns, [str(t) for t in rel.types]))
+        if types.get("geometry") != "GEOMETRY":
+            return rel.df()
+
+        # Return geometry as WKB
+        df = self.con.sql(
+            "SELECT * REPLACE (ST_AsWKB(geometry) AS geometry) "
+            "FROM ({})".format(q.strip().rstrip(";")), params=data).df()
+        if srid is None:
+            srid = self._guess_srid(q)
+        geometry = gpd.GeoSeries.from_wkb(
+            [bytes(x) if x is not None else None for x in df["geometry"]])
+        return gpd.GeoDataFrame(
+            df.drop("geometry", axis=1), geometry=geometry.values,
+            crs=self.get_crs(srid) if srid is not None else None)
+
+    def _guess_srid(self, q):
+        """
+        Returns the SRID of the spatial tables referenced by the query if
+        they all share one, otherwise None.
+        """
+        srids = set(
+            srid for table, srid in self.con.execute(
+                "SELECT f_table_name, srid FROM {}".format(
+                    GEOMETRY_COLUMNS_TABLE)).fetchall()
+            if re.search(r"\b{}\b".format(re.escape(table)), q))
+        if len(srids) == 1:
+            return srids.pop()
+        return None
+
+    def get_crs(self, srid):
+        """
+        Get the coordinate reference system (GeoPandas format) for the input
+        spatial reference ID, like ``SpatiaLiteDB.get_crs``.
+        """
+        row = self.con.execute(
+            "SELECT proj4text FROM {} WHERE srid = ? "
+            "AND proj4text IS NOT NULL LIMIT 1".format(GEOMETRY_COLUMNS_TABLE),
+            [int(srid)]).fetchone()
+        if row is not None:
+            return fiona.crs.from_string(row[0])
+        return fiona.crs.from_epsg(int(srid))
+
+    def load_geodataframe(self, gdf, table_name, srid, validate=True,
+                          if_exists="fail", **kwargs):
+        """
+        Creates a database table from a geopandas.GeoDataFrame
+
+        Parameters
+        ----------
+        gdf: pandas.GeoDataFrame
+            GeoDataFrame to load into database as a spatial table. This could
+            also be a normal DataFrame with geometry stored as Well-Known Text
+            in a Series called 'wkt'.
+        table_name: str
+            The name of the table to create from the gdf
+        srid: int
+            Spatial Reference ID for the geometry
+        validate: bool
+            Repair invalid geometries with ST_MakeValid. Default True
+        if_exists: str ({'fail', 'replace', 'append'}, default 'fail')
+            How to behave if the table already exists.
+
+                * fail: Raise a ValueError.
+                * replace: Drop the table before inserting new values.
+                * append: Insert new values to the existing table.
+        """
+        rcols = ["SQL", "Result"]
+        exists = table_name in self.table_names
+        if exists and if_exists == "fail":
+            raise ValueError("Table '{}' already exists.".format(table_name))
+        if if_exists not in ("fail", "replace", "append"):
+            raise ValueError("'{}' is not valid for if_exists".format(
+                if_exists))
+        # Auto-convert Well-Known Text to shapely
+        if "geometry" not in gdf.columns and "wkt" in gdf.columns:
+            gdf = gpd.GeoDataFrame(
+                gdf.drop("wkt", axis=1),
+                geometry=gpd.GeoSeries(gdf["wkt"].apply(shapely.wkt.loads)))
+        geom_type = max(set(gdf["geometry"].geom_type), key=len).upper()
+        df = pd.DataFrame(gdf.drop("geometry", axis=1))
+        df["geometry"] = gpd.GeoSeries(gdf["geometry"]).to_wkb().values
+
+        if exists and if_exists == "replace":
+            self.con.execute("DROP TABLE {}".format(table_name))
+        self.con.register("_spatialdb_load", df)
+        try:
+            select = ("SELECT * REPLACE "
+                      "(ST_GeomFromWKB(geometry) AS geometry) "
+                      "FROM _spatialdb_load")
+            if exists and if_exists == "append":
+                self.con.execute("INSERT INTO {} BY NAME {}".format(
+                    table_name, select))
+            else:
+                self.con.execute("CREATE TABLE {} AS {}".format(
+                    table_name, select))
+        finally:
+            self.con.unregister("_spatialdb_load")
+        if validate:
+            self.con.execute(
+                "UPDATE {} SET geometry = ST_MakeValid(geometry) "
+                "WHERE NOT ST_IsValid(geometry)".format(table_name))
+
+        proj4 = gdf.crs.to_proj4() if getattr(gdf, "crs", None) else None
+        self._register_geometry(table_name, geom_type, srid, proj4)
+        return pd.DataFrame([["load_geodataframe()", len(gdf)]],
+                            columns=rcols)
+
+    def attach_spatialite(self, filename, tables=None, materialize=False):
+        """
+        Makes the spatial tables of a SpatiaLite database available (read
+        through GDAL's ``ST_Read``).
+
+        Parameters
+        ----------
+        filename: str
+            Path to the SpatiaLite database
+        tables: list
+            Names of the spatial tables to attach. Default: all
+        materialize: bool
+            Copy the tables into DuckDB rather than creating views. Copies
+            are faster to query repeatedly. Default False
+
+        Returns
+        -------
+        list:
+            Names of the attached tables
+        """
+        con = sqlite3.connect(filename)
+        try:
+            rows = con.execute(
+                "SELECT g.f_table_name, g.f_geometry_column, "
+                "g.geometry_type, g.srid, s.proj4text "
+                "FROM geometry_columns g "
+                "LEFT JOIN spatial_ref_sys s ON g.srid = s.srid").fetchall()
+        finally:
+            con.close()
+        attached = []
+        for table, geom_col, geom_type, srid, proj4 in rows:
+            if tables is not None and table not in tables:
+                continue
+            self.con.execute(
+                "CREATE OR REPLACE {kind} {table} AS "
+                "SELECT * EXCLUDE (geom), geom AS geometry "
+                "FROM ST_Read('{path}', layer='{table}')".format(
+                    kind="TABLE" if materialize else "VIEW",
+                    table=table,
+                    path=filename.replace("'", "''")))
+            self._register_geometry(
+                table, GEOM_TYPES.get(int(geom_type) % 1000, "GEOMETRY"),
+                srid, proj4)
+            attached.append(table)
+        return attached
+
+    def _register_geometry(self, table_name, geom_type, srid, proj4text):
+        """Adds (or replaces) a table in the GEOMETRY_COLUMNS_TABLE."""
+        self.con.execute(
+            "INSERT OR REPLACE INTO {} VALUES (?, ?, ?, ?, ?)".format(
+                GEOMETRY_COLUMNS_TABLE),
+            [table_name, "geometry", geom_type, int(srid), proj4text])
+
+    def __str__(self):
+        return "SpatialDB[DuckDB/spatial] > {dbname}".format(
+            dbname=self.dbname)
+
+    def __repr__(self):
+        return self.__str__()
@@ -1,14 +1,8 @@
 # !/usr/bin/env python2
 
-import os
 import re
 import struct
-try:
-    from urllib2 import urlopen
-except ImportError:
-    from urllib.request import urlopen
-
-import shapely
+from collections import OrderedDict
 
 
 def get_sr_from_web(srid, auth, sr_format):
@@ -61,6 +55,10 @@ def get_sr_from_web(srid, auth, sr_format):
     if sr_format == "spatialite":
         site = site.replace("spatialite", "postgis")
 
+    try:
+        from urllib2 import urlopen
+    except ImportError:
+        from urllib.request import urlopen
     data = urlopen(site).read()
     if hasattr(data, "decode"):
         data = data.decode("utf8")
@@ -70,7 +68,430 @@ def get_sr_from_web(srid, auth, sr_format):
     return data
 
 
-# TODO: Errors on geometries with Z and/or M values
+class LRUCache(object):
+    """
+    Bounded least-recently-used cache with hit and miss counters.
+
+    Parameters
+    ----------
+    maxsize: int
+        Maximum number of cached items (0 disables caching)
+    """
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+
+    def get(self, key, default=None):
+        """Get a cached item (counted as a hit or a miss)."""
+        try:
+            value = self._items.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self._items[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """Cache an item, evicting the least recently used if full."""
+        if self.maxsize <= 0:
+            return
+        self._items.pop(key, None)
+        self._items[key] = value
+        while len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+    def clear(self):
+        """Remove all items and reset the counters."""
+        self._items.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        """Dictionary of the cache's hits, misses, hit rate and size."""
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": float(self.hits) / total if total else 0.0,
+            "size": len(self._items),
+            "maxsize": self.maxsize}
+
+    def __len__(self):
+        return len(self._items)
+
+
+# Cache of pyproj Transformers by (from, to) proj4 text
+_TRANSFORMERS = {}
+
+
+def get_transformer(from_proj4, to_proj4):
+    """
+    Get a (cached) pyproj Transformer between two proj4 definitions.
+
+    Parameters
+    ----------
+    from_proj4: str
+        proj4 text of the source spatial reference
+    to_proj4: str
+        proj4 text of the target spatial reference
+    """
+    key = (from_proj4, to_proj4)
+    if key not in _TRANSFORMERS:
+        from pyproj import Transformer
+        _TRANSFORMERS[key] = Transformer.from_crs(
+            from_proj4, to_proj4, always_xy=True)
+    return _TRANSFORMERS[key]
+
+
+def transform_geometries(geoms, from_proj4, to_proj4):
+    """
+    Reproject an array of shapely geometries in bulk (all coordinates are
+    transformed in a single pyproj call per coordinate dimension).
+
+    Parameters
+    ----------
+    geoms: array-like
+        shapely geometries
+    from_proj4: str
+        proj4 text of the source spatial reference
+    to_proj4: str
+        proj4 text of the target spatial reference
+
+    Returns
+    -------
+    numpy.ndarray:
+        Array of reprojected shapely geometries
+    """
+    import numpy as np
+    import shapely
+
+    transformer = get_transformer(from_proj4, to_proj4)
+    geoms = np.asarray(geoms, dtype=object)
+    has_z = shapely.has_z(geoms)
+
+    def _transform(coords):
+        return np.column_stack(transformer.transform(*coords.T))
+
+    # 2D geometries given z=NaN come back with NaN x/y: transform them apart
+    if has_z.all() or not has_z.any():
+        return shapely.transform(geoms, _transform,
+                                 include_z=bool(has_z.any()))
+    out = geoms.copy()
+    out[has_z] = shapely.transform(geoms[has_z], _transform, include_z=True)
+    out[~has_z] = shapely.transform(geoms[~has_z], _transform,
+                                    include_z=False)
+    return out
+
+
+def nearest_neighbors(geoms, sources, k=1, max_distance=None):
+    """
+    Find the ``k`` nearest geometries to each source geometry using a
+    shapely STRtree and a search radius that doubles until enough
+    neighbours are found.
+
+    Parameters
+    ----------
+    geoms: array-like
+        shapely geometries to search
+    sources: array-like
+        shapely geometries to find the neighbours of
+    k: int
+        Number of neighbours per source geometry
+    max_distance: float
+        Maximum distance of the neighbours
+
+    Returns
+    -------
+    tuple:
+        Arrays of source positions, ``geoms`` positions, distances and ranks
+        (sorted by source and distance)
+    """
+    import numpy as np
+    import shapely
+
+    geoms = np.asarray(geoms, dtype=object)
+    sources = np.asarray(sources, dtype=object)
+    tree = shapely.STRtree(geoms)
+    valid = ~(shapely.is_missing(sources) | shapely.is_empty(sources))
+    pending = np.flatnonzero(valid)
+    n = len(tree)
+    src, tgt, dist = [np.array([], dtype=int)], [np.array([], dtype=int)], [
+        np.array([])]
+    if n == 0:
+        pending = pending[:0]
+    else:
+        xmin, ymin, xmax, ymax = shapely.total_bounds(geoms)
+        diag = np.hypot(xmax - xmin, ymax - ymin)
+        # Start with the radius expected to hold k geometries
+        radius = max(diag * np.sqrt(float(k) / n), diag * 1e-9, 1e-9)
+
+    while len(pending):
+        if max_distance is not None:
+            radius = min(radius, max_distance)
+        s, t = tree.query(
+            sources[pending], predicate="dwithin", distance=radius)
+        counts = np.bincount(s, minlength=len(pending))
+        done = (counts >= k) | (counts == n)
+        if max_distance is not None and radius >= max_distance:
+            done[:] = True
+        keep = done[s]
+        s = pending[s[keep]]
+        t = t[keep]
+        src.append(s)
+        tgt.append(t)
+        dist.append(shapely.distance(sources[s], geoms[t]))
+        pending = pending[~done]
+        radius *= 2
+
+    src, tgt, dist = [np.concatenate(a) for a in (src, tgt, dist)]
+    order = np.lexsort((tgt, dist, src))
+    src, tgt, dist = src[order], tgt[order], dist[order]
+    # Rank of each neighbour within its source
+    starts = np.flatnonzero(np.r_[True, src[1:] != src[:-1]])
+    rank = np.arange(len(src)) - np.repeat(starts, np.diff(
+        np.r_[starts, len(src)]))
+    keep = rank < k
+    return src[keep], tgt[keep], dist[keep], rank[keep]
+
+
+def hilbert_keys(x, y, bounds=None, order=16):
+    """
+    Compute the distance along a Hilbert curve of each (x, y) coordinate.
+
+    Parameters
+    ----------
+    x: array-like
+        x coordinates
+    y: array-like
+        y coordinates
+    bounds: tuple
+        (minx, miny, maxx, maxy) mapped onto the curve. Default: extent of
+        the coordinates
+    order: int
+        Order of the curve (the extent is split into 2**order cells per
+        axis). Default 16
+
+    Returns
+    -------
+    numpy.ndarray:
+        Hilbert distances (int64); NaN coordinates sort last
+    """
+    import numpy as np
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    missing = np.isnan(x) | np.isnan(y)
+    if bounds is None:
+        if missing.all():
+            return np.full(len(x), -1, dtype=np.int64)
+        bounds = (np.nanmin(x), np.nanmin(y), np.nanmax(x), np.nanmax(y))
+    minx, miny, maxx, maxy = bounds
+    n = 2 ** order
+
+    def _scale(values, low, high):
+        span = float(high - low) or 1.0
+        cells = np.floor((values - low) / span * (n - 1))
+        return np.clip(np.nan_to_num(cells), 0, n - 1).astype(np.int64)
+
+    xi = _scale(x, minx, maxx)
+    yi = _scale(y, miny, maxy)
+    keys = np.zeros(len(xi), dtype=np.int64)
+    s = n // 2
+    while s > 0:
+        rx = (xi & s) > 0
+        ry = (yi & s) > 0
+        keys += s * s * ((3 * rx.astype(np.int64)) ^ ry.astype(np.int64))
+        # Rotate the quadrant
+        flip = ~ry & rx
+        xi = np.where(flip, n - 1 - xi, xi)
+        yi = np.where(flip, n - 1 - yi, yi)
+        swap = ~ry
+        xi, yi = np.where(swap, yi, xi), np.where(swap, xi, yi)
+        s //= 2
+    keys[missing] = n * n
+    return keys
+
+
+def hex_bin(x, y, cell_size):
+    """
+    Compute the axial (q, r) coordinates of the pointy-top hexagons containing
+    each (x, y) coordinate, the hexagon centered on (0, 0) being (0, 0).
+
+    Parameters
+    ----------
+    x: array-like
+        x coordinates
+    y: array-like
+        y coordinates
+    cell_size: float
+        Width of the hexagons (distance between opposite sides)
+
+    Returns
+    -------
+    tuple:
+        (q, r) arrays of int64
+    """
+    import numpy as np
+
+    radius = cell_size / np.sqrt(3)
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    fq = (np.sqrt(3) / 3 * x - y / 3) / radius
+    fr = (2 / 3 * y) / radius
+    fs = -fq - fr
+    # Round the cube coordinates, fixing the component with the largest error
+    q, r, s = np.round(fq), np.round(fr), np.round(fs)
+    dq, dr, ds = np.abs(q - fq), np.abs(r - fr), np.abs(s - fs)
+    fix_q = (dq > dr) & (dq > ds)
+    fix_r = ~fix_q & (dr > ds)
+    q = np.where(fix_q, -r - s, q)
+    r = np.where(fix_r, -q - s, r)
+    return q.astype(np.int64), r.astype(np.int64)
+
+
+def hex_polygons(q, r, cell_size, x0=0.0, y0=0.0):
+    """
+    Build the pointy-top hexagons of axial coordinates (q, r) (see hex_bin)
+    on a grid centered on (x0, y0).
+
+    Returns
+    -------
+    numpy.ndarray:
+        Array of shapely Polygons
+    """
+    import numpy as np
+    import shapely
+
+    radius = cell_size / np.sqrt(3)
+    q = np.asarray(q, dtype=float)
+    r = np.asarray(r, dtype=float)
+    cx = x0 + cell_size * (q + r / 2)
+    cy = y0 + 1.5 * radius * r
+    angles = np.radians(30 + 60 * np.arange(7))
+    coords = np.stack([cx[:, None] + radius * np.cos(angles),
+                       cy[:, None] + radius * np.sin(angles)], axis=-1)
+    return shapely.polygons(coords)
+
+
+# Marker preceding each entity of a SpatiaLite collection BLOB
+_BLOB_ENTITY = 0x69
+
+
+def _blob_coords(array, offset, endian, n, ncoord, has_m, compressed):
+    """
+    Reads ``n`` vertices of a SpatiaLite BLOB at ``offset`` and returns them
+    as WKB coordinates (doubles) and the offset of the next value.
+
+    Compressed vertices (other than the first and last) are stored as float
+    deltas from the previous vertex; M values are never compressed.
+    """
+    import numpy as np
+
+    size = n * ncoord * 8
+    if not compressed or n < 3:
+        return bytes(array[offset:offset + size]), offset + size
+    nfloat = ncoord - 1 if has_m else ncoord
+    fields = [("delta", endian + "f4", (nfloat,))]
+    if has_m:
+        fields.append(("m", endian + "f8"))
+    mid = np.dtype(fields)
+    first = np.frombuffer(array, endian + "f8", ncoord, offset)
+    offset += ncoord * 8
+    deltas = np.frombuffer(array, mid, n - 2, offset)
+    offset += (n - 2) * mid.itemsize
+    last = np.frombuffer(array, endian + "f8", ncoord, offset)
+    offset += ncoord * 8
+    coords = np.empty((n, ncoord))
+    coords[0] = first
+    coords[-1] = last
+    # Accumulate sequentially, as SpatiaLite does
+    steps = np.vstack([first[:nfloat], deltas["delta"].astype(float)])
+    coords[1:-1, :nfloat] = np.cumsum(steps, axis=0)[1:]
+    if has_m:
+        coords[1:-1, -1] = deltas["m"]
+    return coords.astype(endian + "f8").tobytes(), offset
+
+
+def _blob_entity(array, offset, endian, class_type, out):
+    """
+    Appends the WKB (without byte order) of a SpatiaLite BLOB entity of class
+    ``class_type`` at ``offset`` to ``out``; returns the next offset.
+    """
+    compressed = class_type >= 1000000
+    dims = class_type % 1000000 // 1000 * 1000
+    base = class_type % 1000
+    ncoord = {0: 2, 1000: 3, 2000: 3, 3000: 4}[dims]
+    has_m = dims in (2000, 3000)
+    out += struct.pack(endian + "I", base + dims)
+
+    def count(offset):
+        n = struct.unpack_from(endian + "i", array, offset)[0]
+        out.extend(array[offset:offset + 4])
+        return n, offset + 4
+
+    if base == 1:
+        coords, offset = _blob_coords(
+            array, offset, endian, 1, ncoord, has_m, False)
+        out += coords
+    elif base == 2:
+        n, offset = count(offset)
+        coords, offset = _blob_coords(
+            array, offset, endian, n, ncoord, has_m, compressed)
+        out += coords
+    elif base == 3:
+        rings, offset = count(offset)
+        for _ in range(rings):
+            n, offset = count(offset)
+            coords, offset = _blob_coords(
+                array, offset, endian, n, ncoord, has_m, compressed)
+            out += coords
+    elif base in (4, 5, 6, 7):
+        n, offset = count(offset)
+        for _ in range(n):
+            if array[offset] != _BLOB_ENTITY:
+                raise ValueError("Invalid SpatiaLite BLOB entity")
+            out.append(array[1])
+            child = struct.unpack_from(endian + "i", array, offset + 1)[0]
+            offset = _blob_entity(array, offset + 5, endian, child, out)
+    else:
+        raise ValueError("Unknown SpatiaLite geometry class: {}".format(
+            class_type))
+    return offset
+
+
+def spatialite_blob_to_wkb(geom_buffer):
+    """
+    Converts a SpatiaLite BLOB geometry (any class: XY, Z, M and ZM,
+    compressed or not, and TinyPoints) into ISO Well-Known Binary.
+    See specification: https://www.gaia-gis.it/gaia-sins/BLOB-Geometry.html
+
+    Returns
+    -------
+    tuple:
+        (srid, class type, WKB)
+    """
+    array = bytearray(geom_buffer)
+    if array[1] in (0x80, 0x81):
+        # TinyPoint: class (1: XY, 2: XYZ, 3: XYM, 4: XYZM) then coordinates
+        endian = "<" if array[1] == 0x81 else ">"
+        srid = struct.unpack_from(endian + "i", array, 2)[0]
+        class_type = (array[6] - 1) * 1000 + 1
+        wkb = bytearray([array[1] & 1])
+        wkb += struct.pack(endian + "I", class_type)
+        wkb += array[7:-1]
+        return srid, class_type, bytes(wkb)
+    # List of Big- or Little-Endian identifiers
+    endian = [">", "<"][array[1]]
+    srid = struct.unpack_from(endian + "i", array, 2)[0]
+    class_type = struct.unpack_from(endian + "i", array, 39)[0]
+    wkb = bytearray(array[1:2])
+    _blob_entity(array, 43, endian, class_type, wkb)
+    return srid, class_type, bytes(wkb)
+
+
 class SpatiaLiteBlobElement(object):
     """
     SpatiaLite Blob Element
@@ -87,30 +508,20 @@ class SpatiaLiteBlobElement(object):
             The geometry type native to SpatiaLite (BLOB geometry)
         """
         self.blob = geom_buffer
-        # Get as bytearray
-        array = bytearray(self.blob)
-        # List of Big- or Little-Endian identifiers
-        endian = [">", "<"][array[1]]
-
-        # Decode the Spatial Reference ID
-        self.srid = "{}".format(struct.unpack(endian + 'i', array[2:6])[0])
-        self.geom_type = "{}".format(struct.unpack(endian + 'i', array[39:43])[0])
-
-        # Create WKB from Endian (pos 1) and SpatiaLite-embeded WKB data
-        # at pos 39+
-        try:
-            self.wkb = bytes(geom_buffer[1:2]) + array[39:-1]
-        except:  # TODO: naked for Python2.7
-            self.wkb = str(geom_buffer[1] + array[39:-1])
+        srid, geom_type, self.wkb = spatialite_blob_to_wkb(geom_buffer)
+        self.srid = "{}".format(srid)
+        self.geom_type = "{}".format(geom_type)
 
     @property
     def as_shapely(self):
         """Return SpatiaLite BLOB as shapely object."""
+        import shapely.wkb
         return shapely.wkb.loads(self.wkb)
 
     @property
     def as_wkt(self):
         """Return SpatiaLite BLOB as Well Known Text."""
+        import shapely.wkt
         return shapely.wkt.dumps(self.as_shapely)
 
     @property
@@ -119,4 +530,4 @@ class SpatiaLiteBlobElement(object):
         return "SRID={};{}".format(self.srid, self.as_wkt)
 
     def __str__(self):
-        return self.ewkt
+        return self.as_ewkt
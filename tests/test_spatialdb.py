@@ -5,10 +5,23 @@ Test ext.spatialdb module
 
 from __future__ import unicode_literals
 
+import json
 import os
+import sqlite3
+import struct
+import subprocess
+import sys
+import threading
+import time
 import unittest
 
 import geopandas as gpd
+import numpy as np
+import shapely
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
 
 #from db2.ext import spatialdb as sdb
 import spatialdb as sdb
@@ -37,6 +50,61 @@ class UtilTests(unittest.TestCase):
         # If run again, do nothing
         self.assertEqual(d.get_spatial_ref_sys(102700, "esri"), 0)
 
+    def test_blob_element(self):
+        # GEOMETRYCOLLECTION Z (POINT Z (1 2 3)): entities start with 0x69
+        blob = (b"\x00\x01" + struct.pack("<i4d", 4326, 1, 2, 1, 2) +
+                b"\x7c" + struct.pack("<ii", 1007, 1) + b"\x69" +
+                struct.pack("<i3d", 1001, 1, 2, 3) + b"\xfe")
+        element = sdb.SpatiaLiteBlobElement(blob)
+        self.assertEqual(element.srid, "4326")
+        self.assertTrue(element.as_shapely.equals_exact(
+            shapely.from_wkt("GEOMETRYCOLLECTION Z (POINT Z (1 2 3))"), 0))
+
+    def test_transform_geometries(self):
+        # 2D and 3D geometries mixed in one array
+        geoms = [shapely.Point(-110, 45), shapely.Point(-110, 45, 10), None]
+        out = sdb.utils.transform_geometries(
+            geoms, "+proj=longlat +datum=WGS84 +no_defs", "EPSG:3857")
+        self.assertFalse(shapely.has_z(out[0]))
+        self.assertAlmostEqual(out[0].x, -12245143.987, 3)
+        self.assertEqual((out[0].x, out[0].y), (out[1].x, out[1].y))
+        self.assertEqual(out[1].z, 10)
+        self.assertTrue(out[2] is None)
+
+
+class ImportTimeTests(unittest.TestCase):
+    def test_lazy_import(self):
+        # Importing the package alone must not pull in the heavy dependencies
+        heavy = ("db2", "fiona", "geopandas", "pandas", "shapely",
+                 "sqlalchemy")
+        script = (
+            "import os, sys, time\n"
+            "t = time.time()\n"
+            "import spatialdb\n"
+            "print(time.time() - t)\n"
+            "print(','.join(m for m in {!r} if m in sys.modules))\n"
+            "print('SPATIALITE_SECURITY' in os.environ)\n").format(heavy)
+        env = dict(os.environ)
+        env.pop("SPATIALITE_SECURITY", None)
+        out = subprocess.check_output(
+            [sys.executable, "-c", script], env=env).decode().splitlines()
+        self.assertLess(float(out[0]), 0.5)
+        self.assertEqual(out[1], "")
+        self.assertEqual(out[2], "False")
+
+    def test_lazy_names(self):
+        self.assertTrue(callable(sdb.SpatiaLiteDB))
+        self.assertTrue(issubclass(sdb.SpatiaLiteError, Exception))
+        self.assertTrue("SpatiaLiteDB" in dir(sdb))
+        # Every public name resolves
+        namespace = {}
+        exec("from spatialdb import *", namespace)
+        for name in sdb.__all__:
+            self.assertTrue(name in namespace, name)
+        # duckdb is optional
+        self.assertFalse("DuckDBSpatialDB" in sdb.__all__)
+        self.assertTrue("DuckDBSpatialDB" in dir(sdb))
+
 
 class MainTests(unittest.TestCase):
     def test_sql_empty_df(self):
@@ -56,6 +124,26 @@ class MainTests(unittest.TestCase):
         df = d.sql("SELECT * FROM spatial_ref_sys WHERE srid = 4326")
         self.assertTrue(not df.empty and df["srid"].iat[0] == 4326)
 
+    def test_sql_cache(self):
+        d = sdb.SpatiaLiteDB(":memory:")
+        d.clear_cache()
+        q = "SELECT * FROM spatial_ref_sys WHERE srid = {{ srid }}"
+        for srid in (4326, 3857, 4326):
+            df = d.sql(q, data={"srid": srid})
+            self.assertEqual(df["srid"].iat[0], srid)
+        info = d.cache_info()
+        # The repeated statement is served before the template is looked up
+        self.assertEqual(info.loc["statements", "hits"], 1)
+        self.assertEqual(info.loc["statements", "misses"], 2)
+        self.assertEqual(info.loc["templates", "hits"], 1)
+        self.assertEqual(info.loc["templates", "misses"], 1)
+        # 1 and 1.0 are equal but render differently
+        self.assertEqual(
+            d.sql("SELECT {{ v }} / 2 AS v", data={"v": 1})["v"].iat[0], 0)
+        self.assertEqual(
+            d.sql("SELECT {{ v }} / 2 AS v", data={"v": 1.0})["v"].iat[0],
+            0.5)
+
 
 class ImportTests_Memory(unittest.TestCase):
     def setUp(self):
@@ -71,6 +159,181 @@ class ImportTests_Memory(unittest.TestCase):
             d.sql(("SELECT DISTINCT IsValid(geometry) "
                    "FROM wild")).iloc[0]["IsValid(geometry)"], 1)
 
+    def test_load_geodataframe_upsert(self):
+        d = sdb.SpatiaLiteDB(":memory:")
+        gdf = gpd.read_file(WILDERNESS)
+        gdf["fid"] = range(len(gdf))
+        d.load_geodataframe(gdf.copy(), "wild", 4326, if_exists="upsert",
+                            pk_column="fid")
+        # Move one feature, drop two and add one
+        gdf.loc[0, "geometry"] = gdf.loc[1, "geometry"]
+        gdf = gdf.drop([2, 3])
+        gdf.loc[9999] = gdf.loc[4]
+        gdf.loc[9999, "fid"] = 9999
+        r = d.load_geodataframe(gdf.copy(), "wild", 4326, if_exists="upsert",
+                                pk_column="fid").set_index("SQL")["Result"]
+        self.assertEqual(r["INSERT"], 1)
+        self.assertEqual(r["UPDATE"], 1)
+        self.assertEqual(r["DELETE"], 2)
+        self.assertEqual(
+            d.sql("SELECT COUNT(*) AS n FROM wild")["n"].iat[0], len(gdf))
+        # Nothing changed; nothing to do
+        r = d.load_geodataframe(gdf.copy(), "wild", 4326, if_exists="upsert",
+                                pk_column="fid")
+        self.assertEqual(r["Result"].iloc[-3:].sum(), 0)
+        # Rows deleted outside upsert are inserted again
+        d.sql("DELETE FROM wild WHERE fid = 9999")
+        r = d.load_geodataframe(gdf.copy(), "wild", 4326, if_exists="upsert",
+                                pk_column="fid").set_index("SQL")["Result"]
+        self.assertEqual(r["INSERT"], 1)
+        self.assertEqual(r["UPDATE"], 0)
+        # Hashes of a replaced table are forgotten
+        v1 = gdf.copy()
+        v2 = gdf.copy()
+        v2["geometry"] = v2.geometry.translate(1, 0)
+        d.load_geodataframe(v2.copy(), "wild", 4326, if_exists="replace",
+                            index=False)
+        r = d.load_geodataframe(v1.copy(), "wild", 4326, if_exists="upsert",
+                                pk_column="fid").set_index("SQL")["Result"]
+        self.assertEqual(r["UPDATE"], len(v1))
+
+    def test_to_srid(self):
+        d = sdb.SpatiaLiteDB(":memory:")
+        gdf = gpd.read_file(WILDERNESS)
+        d.load_geodataframe(gdf.copy(), "wild", 4326, to_srid=3857)
+        self.assertEqual(d.get_geometry_data("wild")["srid"], 3857)
+        wgs84 = d.sql("SELECT * FROM wild", to_srid=4326)
+        self.assertTrue(wgs84.geom_almost_equals(gdf.geometry, 6).all())
+        chunks = list(d.iter_sql("SELECT * FROM wild", chunksize=500,
+                                 to_srid=4326))
+        self.assertEqual([len(c) for c in chunks], [500, 242])
+        self.assertEqual(chunks[0].crs, wgs84.crs)
+
+    def test_nearest(self):
+        d = sdb.SpatiaLiteDB(":memory:")
+        d.import_shp(WILDERNESS, "wild", srid=4326, spatial_index=1)
+        gdf = d.sql("SELECT * FROM wild")
+        sources = gdf.geometry.iloc[:5]
+        knn = d.nearest("wild", sources, k=2, method="knn")
+        tree = d.nearest("wild", sources, k=2, method="strtree")
+        self.assertEqual(len(tree), 10)
+        self.assertEqual(tree["source"].tolist(),
+                         [0, 0, 1, 1, 2, 2, 3, 3, 4, 4])
+        # Each feature is its own nearest neighbour
+        self.assertTrue((tree[tree["rank"] == 0]["distance"] == 0).all())
+        self.assertEqual(knn["target_rowid"].tolist(),
+                         tree["target_rowid"].tolist())
+        # Plain lists are numbered by position
+        r = d.nearest("wild", list(sources.iloc[3:5]))
+        self.assertEqual(r["source"].tolist(), [0, 1])
+        self.assertEqual(r["target_rowid"].tolist(),
+                         tree[tree["rank"] == 0]["target_rowid"].tolist()[3:])
+        # Batch query from another table
+        r = d.nearest("wild", "wild", max_distance=0)
+        self.assertEqual(len(r), len(gdf))
+
+    def test_lookup_index(self):
+        d = sdb.SpatiaLiteDB(":memory:")
+        gdf = gpd.read_file(WILDERNESS)
+        points = gdf.geometry.copy()
+        gdf["fid"] = range(len(gdf))
+        gdf["geometry"] = gdf.geometry.buffer(0.01)
+        d.load_geodataframe(gdf[["fid", "geometry"]].copy(), "zones", 4326)
+        index = d.lookup_index("zones", columns=["fid"])
+        self.assertEqual(len(index), len(gdf))
+        r = index.contains(points.x.values, points.y.values)
+        self.assertEqual(r["fid"].tolist(), gdf["fid"].tolist())
+        self.assertTrue(index.contains([1000.0], [1000.0])["fid"].isna().all())
+        # Refreshes when the table changes
+        self.assertFalse(index.refresh())
+        d.sql("DELETE FROM zones WHERE fid = 0")
+        self.assertTrue(index.contains(points.values[:1])["fid"].isna().all())
+        self.assertEqual(len(index), len(gdf) - 1)
+
+    def test_build_lod(self):
+        d = sdb.SpatiaLiteDB(":memory:")
+        gdf = gpd.read_file(WILDERNESS)
+        gdf["geometry"] = gdf.geometry.buffer(0.1, 64)
+        d.load_geodataframe(gdf, "zones", 4326)
+        lods = d.build_lod("zones", [0.01, 0.001])
+        self.assertEqual(lods["lod_table"].tolist(),
+                         ["zones_lod1", "zones_lod2"])
+        self.assertTrue("zones_lod2" in d.geometries["f_table_name"].tolist())
+        self.assertEqual(d.lod_table("zones", 0.0001), "zones")
+        self.assertEqual(d.lod_table("zones", 0.005), "zones_lod1")
+        self.assertEqual(d.lod_table("zones", 1), "zones_lod2")
+        full = d.query_lod("zones", 0)
+        low = d.query_lod("zones", 1)
+        self.assertEqual(len(full), len(low))
+        self.assertLess(shapely.get_num_coordinates(low.geometry).sum(),
+                        shapely.get_num_coordinates(full.geometry).sum())
+        bbox = d.query_lod("zones", 1, bbox=gdf.geometry.iloc[0].bounds)
+        self.assertTrue(0 < len(bbox) < len(full))
+        # Levels are rejected once the table changed
+        d.sql("DELETE FROM zones WHERE rowid = 1")
+        self.assertRaises(sdb.SpatiaLiteError, d.query_lod, "zones", 1)
+        d.build_lod("zones", [0.01])
+        self.assertEqual(len(d.query_lod("zones", 1)), len(full) - 1)
+
+    def test_build_lod_z(self):
+        d = sdb.SpatiaLiteDB(":memory:")
+        gdf = gpd.GeoDataFrame(
+            {"n": [1]},
+            geometry=[shapely.from_wkt("LINESTRING Z (0 0 1, 1 1 2, 2 0 3)")])
+        d.load_geodataframe(gdf, "lines", 4326)
+        d.build_lod("lines", [0.1])
+        low = d.query_lod("lines", 1)
+        self.assertFalse(low.geometry.has_z.any())
+
+    def test_validate_table(self):
+        d = sdb.SpatiaLiteDB(":memory:")
+        # make_valid turns the bowtie into two polygons and the spike into a
+        # polygon and a line
+        bowtie = shapely.from_wkt("POLYGON ((0 0, 1 1, 1 0, 0 1, 0 0))")
+        spike = shapely.from_wkt(
+            "POLYGON ((2 2, 3 2, 3 3, 3 4, 3 3, 2 3, 2 2))")
+        gdf = gpd.GeoDataFrame(
+            {"name": ["bowtie", "spike", "box"]},
+            geometry=[bowtie, spike, shapely.box(4, 4, 5, 5)])
+        d.load_geodataframe(gdf, "shapes", 4326, validate=False)
+        r = d.validate_table("shapes", repair=False, workers=1)
+        self.assertEqual(r["reason"].tolist(),
+                         ["Ring Self-intersection", "Self-intersection"])
+        self.assertEqual(r["repaired"].tolist(), [0, 0])
+        self.assertEqual(r["unrepairable"].tolist(), [0, 1])
+        r = d.validate_table("shapes", workers=2, chunksize=1)
+        self.assertEqual(r["invalid"].tolist(), [1, 1])
+        self.assertEqual(r["repaired"].tolist(), [1, 0])
+        self.assertEqual(r["unrepairable"].tolist(), [0, 1])
+        # The bowtie doesn't fit the POLYGON column and is left as is
+        r = d.validate_table("shapes")
+        self.assertEqual(r["reason"].tolist(), ["Self-intersection"])
+        self.assertEqual(d.sql(
+            "SELECT ST_Area(geometry) AS a FROM shapes "
+            "WHERE name = 'spike'")["a"].iat[0], 1)
+
+    def test_aggregate_grid(self):
+        d = sdb.SpatiaLiteDB(":memory:")
+        gdf = gpd.GeoDataFrame(
+            {"value": [1, 2, 3, 4]},
+            geometry=gpd.points_from_xy([0.5, 0.6, 1.5, 5.5],
+                                        [0.5, 0.4, 0.5, 5.5]))
+        d.load_geodataframe(gdf, "pts", 4326)
+        r = d.aggregate_grid("pts", 1, agg={"value": ["sum", "mean"]})
+        self.assertEqual(r["count"].tolist(), [2, 1, 1])
+        self.assertEqual(r["value_sum"].tolist(), [3, 3, 4])
+        self.assertEqual(r["value_mean"].tolist(), [1.5, 3, 4])
+        self.assertTrue(r.geometry.iat[0].equals(shapely.box(0, 0, 1, 1)))
+        r = d.aggregate_grid("pts", 1, agg={"value": "max"}, bbox=(0, 0, 2, 1))
+        self.assertEqual(r["count"].sum(), 3)
+        r = d.aggregate_grid("pts", 1, agg={"value": ["sum", "mean"]},
+                             kind="hex", chunksize=2)
+        self.assertEqual(r["count"].sum(), 4)
+        self.assertEqual(r["value_sum"].sum(), 10)
+        self.assertTrue(r.contains(gdf.geometry.iat[3]).any())
+        self.assertRaises(AttributeError, d.aggregate_grid, "pts", 1,
+                          kind="triangle")
+
     def test_import_shp(self):
         d = sdb.SpatiaLiteDB(":memory:")
         r = d.import_shp(WILDERNESS, "wild", srid=4326)
@@ -78,12 +341,77 @@ class ImportTests_Memory(unittest.TestCase):
         self.assertEqual(r.columns.tolist(), ["SQL", "Result"])
         self.assertEqual(r["Result"].iat[0], 742)
 
+    def test_load_file(self):
+        d = sdb.SpatiaLiteDB(":memory:")
+        r = d.load_file(WILDERNESS, "wild", chunksize=100)
+        self.assertEqual(r["Result"].iat[0], 742)
+        # SRID inferred from the .prj (NAD83)
+        self.assertEqual(d.get_geometry_data("wild")["srid"], 4269)
+        df = d.sql("SELECT * FROM wild")
+        gdf = gpd.read_file(WILDERNESS)
+        self.assertTrue(df.geom_equals(gdf.geometry).all())
+        self.assertRaises(ValueError, d.load_file, WILDERNESS, "wild")
+        d.load_file(WILDERNESS, "wild", if_exists="append")
+        self.assertEqual(len(d.sql("SELECT * FROM wild")), 742 * 2)
+
     def test_get_geom_data(self):
         d = sdb.SpatiaLiteDB(":memory:")
         d.import_shp(WILDERNESS, "wild", srid=4326)
         self.assertEqual(d.get_geometry_data("wild")["srid"], 4326)
         self.assertEqual(d.get_geometry_data("wild")["ref_sys_name"], "WGS 84")
 
+    def test_table_stats(self):
+        d = sdb.SpatiaLiteDB(":memory:")
+        gdf = gpd.GeoDataFrame(
+            {"n": [1, 2]}, geometry=gpd.points_from_xy([0, 5], [1, 2]))
+        d.load_geodataframe(gdf.copy(), "pts", 4326, if_exists="upsert",
+                            pk_column="n")
+        stats = d.table_stats("pts")
+        self.assertEqual(stats["row_count"], 2)
+        self.assertEqual(stats["extent"], (0, 1, 5, 2))
+        self.assertEqual(stats["geometry_types"], ["POINT"])
+        self.assertEqual(stats["dims"], ["XY"])
+        # Inserted rows are merged without a full scan
+        gdf = gpd.GeoDataFrame(
+            {"n": [1, 2, 3]}, geometry=gpd.points_from_xy([0, 5, -4],
+                                                          [1, 2, 9]))
+        d.load_geodataframe(gdf, "pts", 4326, if_exists="upsert",
+                            pk_column="n")
+        self.assertEqual(d.table_stats("pts")["extent"], (-4, 1, 5, 9))
+        # Other changes are detected
+        d.sql("DELETE FROM pts WHERE n = 3")
+        stats = d.table_stats("pts")
+        self.assertEqual(stats["row_count"], 2)
+        self.assertEqual(stats["extent"], (0, 1, 5, 2))
+        self.assertEqual(d.table_stats("pts", refresh=True), stats)
+        # Updates inside the extent are merged and keep the stats current
+        for x in (2, 3):
+            gdf = gpd.GeoDataFrame(
+                {"n": [1, 2, 4]}, geometry=gpd.points_from_xy([0, 5, x],
+                                                              [1, 2, 1.5]))
+            d.load_geodataframe(gdf, "pts", 4326, if_exists="upsert",
+                                pk_column="n")
+        version = d.engine.execute(
+            "SELECT data_version FROM {} WHERE table_name = 'pts'".format(
+                sdb.LAYER_STATS_TABLE)).fetchone()[0]
+        self.assertEqual(json.loads(version), list(d.data_version("pts")))
+        self.assertEqual(d.table_stats("pts")["row_count"], 3)
+        # Deletes within the same millisecond change the row count
+        before = d.data_version("pts")
+        d.sql("DELETE FROM pts WHERE n = 2")
+        self.assertNotEqual(d.data_version("pts"), before)
+        # Reading leaves the user's table untouched (no triggers added)
+        self.assertEqual(d.sql(
+            "SELECT COUNT(*) AS n FROM sqlite_master WHERE type = 'trigger' "
+            "AND name LIKE 'spatialdb%'")["n"].iat[0], 0)
+        # Empty GEOMETRY columns fall back on the registered type
+        d.sql("CREATE TABLE shapes (id INTEGER PRIMARY KEY)")
+        d.sql("SELECT AddGeometryColumn("
+              "'shapes', 'geometry', 4326, 'GEOMETRY', 'XY')")
+        d.alter_geometry("shapes", srid=3857)
+        self.assertEqual(d.get_geometry_data("shapes")["srid"], 3857)
+
+
 class ImportTests_OnDisk(unittest.TestCase):
     def setUp(self):
         self.path = "./tests/test_ondisk.sqlite"
@@ -101,6 +429,231 @@ class ImportTests_OnDisk(unittest.TestCase):
         self.assertEqual(r.columns.tolist(), ["SQL", "Result"])
         self.assertEqual(r["Result"].iat[0], 742)
 
+    def test_open_in_memory(self):
+        self.d = sdb.SpatiaLiteDB(self.path)
+        self.d.import_shp(WILDERNESS, "wild", srid=4326)
+        m = sdb.SpatiaLiteDB.open_in_memory(self.path, pages=16, writeback=0)
+        self.assertEqual(m.dbname, ":memory:")
+        self.assertTrue("wild" in m.geometries["f_table_name"].tolist())
+        self.assertEqual(len(m.sql("SELECT * FROM wild")), 742)
+        # Nothing changed yet
+        self.assertFalse(m.checkpoint())
+        m.sql("DELETE FROM wild WHERE rowid > 700")
+        m.checkpoint()
+        d = sdb.SpatiaLiteDB(self.path)
+        self.assertEqual(len(d.sql("SELECT * FROM wild")), 700)
+        # Schema changes alone are written back too
+        m.sql("CREATE INDEX idx_wild_name ON wild (NAME)")
+        self.assertTrue(m.checkpoint())
+        self.assertFalse(m.checkpoint())
+        d = sdb.SpatiaLiteDB(self.path)
+        self.assertTrue("idx_wild_name" in d.sql(
+            "SELECT name FROM sqlite_master WHERE type = 'index'")[
+                "name"].tolist())
+        # Multi-step methods are only written back once they complete
+        depths = []
+        snapshot_to = m.snapshot_to
+
+        def record(path, **kwargs):
+            depths.append(m._writeback_depth)
+            snapshot_to(path, **kwargs)
+
+        m.snapshot_to = record
+        m.load_geodataframe(gpd.read_file(WILDERNESS), "wild2", 4326)
+        self.assertEqual(depths, [0])
+
+    def test_sql_parallel(self):
+        self.d = sdb.SpatiaLiteDB(self.path)
+        self.d.import_shp(WILDERNESS, "wild", srid=4326)
+        q = "SELECT rowid, geometry FROM wild WHERE {{ partition }}"
+        df = self.d.sql_parallel(q, "wild", workers=2)
+        expected = self.d.sql("SELECT rowid, geometry FROM wild")
+        self.assertEqual(len(df), 742)
+        self.assertEqual(df["rowid"].tolist(), expected["rowid"].tolist())
+        self.assertTrue(df.geom_equals(expected).all())
+        self.assertEqual(df.crs, expected.crs)
+
+    def test_writer(self):
+        self.d = sdb.SpatiaLiteDB(self.path)
+        gdf = gpd.GeoDataFrame(
+            {"n": [0]}, geometry=gpd.points_from_xy([0], [0]))
+        self.d.load_geodataframe(gdf, "pts", 4326)
+        self.assertRaises(AttributeError, sdb.SpatiaLiteDB(":memory:").writer,
+                          "pts")
+
+        def append(start):
+            for i in range(start, start + 100, 10):
+                w.append(gpd.GeoDataFrame(
+                    {"n": range(i, i + 10)},
+                    geometry=gpd.points_from_xy(range(10), range(10))))
+
+        with self.d.writer("pts", batch_size=250) as w:
+            threads = [threading.Thread(target=append, args=(i,))
+                       for i in range(1, 401, 100)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            w.flush()
+            self.assertEqual(len(self.d.sql("SELECT * FROM pts")), 401)
+            stats = w.stats()
+        self.assertEqual(stats["rows"], 400)
+        self.assertEqual(stats["appends"], 40)
+        self.assertTrue(stats["batches"] < 40)
+        self.assertRaises(AttributeError, w.append, gdf)
+        # Closing a clean writer (again) does not raise
+        w.close()
+        w = self.d.writer("pts")
+        w.close()
+        self.assertEqual(w.stats()["rows"], 0)
+        # The writer loads the database's extensions; failing to connect is
+        # raised by close rather than lost with the thread
+        self.d._extensions = ["./tests/data/no_such_extension"]
+        w = self.d.writer("pts")
+        self.assertRaises(sqlite3.OperationalError, w.close)
+
+
+class ClusterTests(unittest.TestCase):
+    def setUp(self):
+        self.path = "./tests/test_cluster.sqlite"
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        rng = np.random.RandomState(0)
+        xy = rng.uniform(0, 1000, (20000, 2))
+        self.gdf = gpd.GeoDataFrame(
+            {"pad": ["x" * 150] * len(xy)},
+            geometry=gpd.points_from_xy(xy[:, 0], xy[:, 1]))
+
+    def test_cluster_table(self):
+        d = sdb.SpatiaLiteDB(":memory:")
+        d.import_shp(WILDERNESS, "wild", srid=4326, spatial_index=1)
+        before = d.sql("SELECT * FROM wild")
+        self.assertRaises(sdb.SpatiaLiteError, d.cluster_table, "wild")
+        d.cluster_table("wild", renumber_pk=True)
+        after = d.sql("SELECT * FROM wild")
+        self.assertEqual(after["PK"].tolist(), list(range(1, 743)))
+        self.assertEqual(sorted(before.geometry.wkb),
+                         sorted(after.geometry.wkb))
+        # The spatial index was rebuilt
+        self.assertEqual(d.sql(
+            "SELECT COUNT(*) AS n FROM idx_wild_geometry")["n"].iat[0], 742)
+
+    def leaf_pages_read(self, d, q):
+        # Map the rows returned by a query to the leaf pages of the table's
+        # b-tree (dbstat lists them in key order)
+        try:
+            leaves = d.engine.execute(
+                "SELECT ncell FROM dbstat WHERE name = 'pts' "
+                "AND pagetype = 'leaf' ORDER BY path;").fetchall()
+        except Exception:
+            self.skipTest("SQLite built without the dbstat virtual table")
+        bounds = np.cumsum([n for n, in leaves])
+        rowids = np.array([r for r, in d.engine.execute(
+            "SELECT rowid FROM pts ORDER BY rowid;").fetchall()])
+        hits = np.array([r for r, in d.engine.execute(q).fetchall()])
+        ranks = np.searchsorted(rowids, hits)
+        return len(np.unique(np.searchsorted(bounds, ranks, side="right")))
+
+    def test_cluster_page_reads(self):
+        # Leaf pages holding the rows found by a bbox query (spatial index)
+        d = sdb.SpatiaLiteDB(self.path)
+        q = ("SELECT rowid FROM pts WHERE rowid IN ("
+             "SELECT rowid FROM SpatialIndex WHERE f_table_name = 'pts' "
+             "AND search_frame = BuildMbr(100, 100, 200, 200));")
+        d.load_geodataframe(self.gdf.copy(), "pts", 3857, validate=False)
+        d.sql("SELECT CreateSpatialIndex('pts', 'geometry');")
+        d.sql("VACUUM;")
+        n = len(d.engine.execute(q).fetchall())
+        unclustered = self.leaf_pages_read(d, q)
+        d.cluster_table("pts", vacuum=True)
+        self.assertEqual(len(d.engine.execute(q).fetchall()), n)
+        clustered = self.leaf_pages_read(d, q)
+        self.assertLess(clustered * 5, unclustered)
+
+
+class StorageTests(unittest.TestCase):
+    def setUp(self):
+        self.path = "./tests/test_storage.sqlite"
+        rng = np.random.RandomState(0)
+        centers = rng.uniform(0, 100000, (2000, 2))
+        self.gdf = gpd.GeoDataFrame(
+            {"n": range(len(centers))},
+            geometry=shapely.buffer(shapely.points(centers), 50,
+                                    quad_segs=16))
+
+    def load(self, **kwargs):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        d = sdb.SpatiaLiteDB(self.path)
+        d.load_geodataframe(self.gdf.copy(), "parcels", 3857, **kwargs)
+        return d
+
+    def blob_class(self, d):
+        blob = d.engine.execute("SELECT geometry FROM parcels").fetchone()[0]
+        return sdb.SpatiaLiteBlobElement(blob).geom_type
+
+    def test_compressed(self):
+        d = self.load(storage="compressed", precision=0.01)
+        self.assertEqual(self.blob_class(d), "1000003")
+        df = d.sql("SELECT n, geometry FROM parcels ORDER BY n")
+        self.assertTrue(df.geom_equals_exact(self.gdf.geometry, 0.01).all())
+        d.alter_geometry("parcels", storage="uncompressed")
+        self.assertEqual(self.blob_class(d), "3")
+        self.assertRaises(AttributeError, d.load_geodataframe, self.gdf,
+                          "other", 3857, storage="zipped")
+
+    def test_storage_benchmark(self):
+        # File size and full scan time (best of 3) by storage mode
+        sizes, scans = [], []
+        for kwargs in ({}, {"precision": 0.01},
+                       {"storage": "compressed", "precision": 0.01}):
+            d = self.load(**kwargs)
+            d.sql("VACUUM")
+            times = []
+            for _ in range(3):
+                start = time.perf_counter()
+                n = len(d.sql("SELECT geometry FROM parcels"))
+                times.append(time.perf_counter() - start)
+                self.assertEqual(n, len(self.gdf))
+            sizes.append(os.path.getsize(self.path))
+            scans.append(min(times))
+        report = "sizes (bytes): {}, scans (s): {}".format(
+            sizes, ["{:.4f}".format(t) for t in scans])
+        # Compressed vertices take roughly half the space of doubles...
+        self.assertLessEqual(sizes[1], sizes[0], report)
+        self.assertLess(sizes[2], 0.75 * sizes[0], report)
+        # ...at the cost of decoding them, which must stay within a loose
+        # bound of the uncompressed scan
+        self.assertLess(scans[2], 5 * scans[0] + 0.05, report)
+
+
+@unittest.skipIf(duckdb is None, "duckdb is not installed")
+class DuckDBTests(unittest.TestCase):
+    def test_load_geodataframe(self):
+        d = sdb.DuckDBSpatialDB(":memory:")
+        self.assertTrue(isinstance(d, sdb.SpatialDB))
+        gdf = gpd.read_file(WILDERNESS)
+        d.load_geodataframe(gdf, "wild", 4326)
+        self.assertTrue("wild" in d.geometries["f_table_name"].tolist())
+        self.assertEqual(d.get_geometry_data("wild")["srid"], 4326)
+        df = d.sql("SELECT * FROM wild")
+        self.assertEqual(len(df), 742)
+        self.assertTrue(df.geom_equals(gdf.geometry).all())
+        self.assertEqual(df.crs.to_epsg(), 4326)
+        # Same CRS type as SpatiaLiteDB
+        self.assertEqual(type(d.get_crs(4326)),
+                         type(sdb.SpatiaLiteDB(":memory:").get_crs(4326)))
+
+    def test_attach_spatialite(self):
+        path = "./tests/test_duckdb_attach.sqlite"
+        if os.path.exists(path):
+            os.remove(path)
+        sdb.SpatiaLiteDB(path).import_shp(WILDERNESS, "wild", srid=4326)
+        d = sdb.DuckDBSpatialDB(":memory:")
+        self.assertEqual(d.attach_spatialite(path), ["wild"])
+        self.assertEqual(
+            d.sql("SELECT COUNT(*) AS n FROM wild")["n"].iat[0], 742)
+
 
 '''
 class ExportTests(unittest.TestCase):